@@ -0,0 +1,54 @@
+import time
+
+import vfe
+
+
+def decode_list_slicing(ctx, buf, formats):
+    # decode_list before offsets were passed through, nested lists are decoded on buf[i:]
+    size_decoder = ctx.create("i")
+    n, = size_decoder.unpack_from(buf, 0)
+    fmt, model = formats[0]
+
+    i = size_decoder.size
+    dec = ctx.create(fmt)
+    formats = formats[1:]
+    models = []
+    for _ in range(n):
+        m = model._make(dec.unpack_from(buf, i))
+        i += dec.size
+        if len(formats) > 0:
+            ii, ms2 = decode_list_slicing(ctx, buf[i:], formats)
+            i += ii
+            m = (m, ms2)
+        models.append(m)
+    return (i, models)
+
+
+def constnode_defs(ctx, n_def, n_node):
+    nodedef = vfe.ConstNodeDef(1, b'def', 0, 1, 1, 1, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    nodes = [vfe.ConstNodeNode(i + 1) for i in range(n_node)]
+    one = ctx.create(vfe.ConstNodeDefFormat).pack(*nodedef) \
+          + vfe.encode_list(ctx, [vfe.ConstNodeNodeFormat], nodes)
+    return ctx.create("i").pack(n_def) + one * n_def
+
+
+def measure(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def bench_nested_list():
+    ctx = vfe.Context("<", 4, 4)
+    formats = [(vfe.ConstNodeDefFormat, vfe.ConstNodeDef), (vfe.ConstNodeNodeFormat, vfe.ConstNodeNode)]
+    print('ConstNodeDef -> ConstNodeNode (10 nodes per def)')
+    print('{:>8} {:>10} {:>12} {:>12}'.format('defs', 'bytes', 'slicing [s]', 'offset [s]'))
+    for n_def in (1000, 2000, 4000, 8000, 16000):
+        buf = constnode_defs(ctx, n_def, 10)
+        sliced = measure(decode_list_slicing, ctx, buf, formats)
+        offset = measure(vfe.decode_list, ctx, buf, formats)
+        print('{:>8} {:>10} {:>12.4f} {:>12.4f}'.format(n_def, len(buf), sliced, offset))
+
+
+if __name__ == '__main__':
+    bench_nested_list()
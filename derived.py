@@ -0,0 +1,179 @@
+from collections import OrderedDict
+
+import numpy as np
+
+import model
+import vre
+
+# ================================
+# 派生出力
+# ================================
+
+# rows computed at once, intermediate float64 arrays stay within a few MB
+DERIVED_CHUNK = 1 << 16
+
+# 合計 : (X, Y, Z) of the vector outputs
+MAGNITUDES = {
+    vre.DISPLACEMENT_TOTAL: (vre.DISPLACEMENT_X, vre.DISPLACEMENT_Y, vre.DISPLACEMENT_Z),
+    vre.VELOCITY_TOTAL: (vre.VELOCITY_X, vre.VELOCITY_Y, vre.VELOCITY_Z),
+    vre.ACCELERATION_TOTAL: (vre.ACCELERATION_X, vre.ACCELERATION_Y, vre.ACCELERATION_Z),
+    vre.FLUID_VELOCITY_TOTAL: (vre.FLUID_VELOCITY_X, vre.FLUID_VELOCITY_Y, vre.FLUID_VELOCITY_Z),
+    vre.CONSTRAINT_FORCE_TOTAL: (vre.CONSTRAINT_FORCE_X, vre.CONSTRAINT_FORCE_Y, vre.CONSTRAINT_FORCE_Z),
+    vre.CHARACTERISTIC_DISPLACEMENT_TOTAL: (vre.CHARACTERISTIC_DISPLACEMENT_X, vre.CHARACTERISTIC_DISPLACEMENT_Y,
+                                            vre.CHARACTERISTIC_DISPLACEMENT_Z),
+    vre.CHARACTERISTIC_FLUID_VELOCITY_TOTAL: (vre.CHARACTERISTIC_FLUID_VELOCITY_X,
+                                              vre.CHARACTERISTIC_FLUID_VELOCITY_Y,
+                                              vre.CHARACTERISTIC_FLUID_VELOCITY_Z),
+}
+
+# 応力成分 : in the argument order of von_mises / principal
+STRESS_COMPONENTS = (vre.NORMAL_STRESS_X, vre.NORMAL_STRESS_Y, vre.NORMAL_STRESS_Z,
+                     vre.SHEAR_STRESS_YZ, vre.SHEAR_STRESS_ZX, vre.SHEAR_STRESS_XY)
+
+# 主応力 : computed together by one eigen solve
+PRINCIPAL_STRESSES = (vre.MAX_PRINCIPAL_STRESS, vre.MIN_PRINCIPAL_STRESS, vre.ABSOLUTE_PRINCIPAL_STRESS)
+
+
+def _chunked(f, components, width, chunk):
+    # f over rows [i, i + chunk) of the components, computed in float64
+    n = len(components[0])
+    dtype = np.result_type(*components)
+    if dtype.kind != 'f':
+        dtype = np.float64
+    out = np.empty((n, width) if width > 1 else n, dtype=dtype)
+    for i in range(0, n, chunk):
+        out[i:i + chunk] = f(*[np.asarray(c[i:i + chunk], dtype=np.float64) for c in components])
+    return out
+
+
+def magnitude(x, y, z, chunk=DERIVED_CHUNK):
+    return _chunked(lambda x, y, z: np.sqrt(x * x + y * y + z * z), (x, y, z), 1, chunk)
+
+
+def _von_mises(sx, sy, sz, syz, szx, sxy):
+    return np.sqrt(0.5 * ((sx - sy) ** 2 + (sy - sz) ** 2 + (sz - sx) ** 2) + 3.0 * (syz * syz + szx * szx + sxy * sxy))
+
+
+def von_mises(sx, sy, sz, syz, szx, sxy, chunk=DERIVED_CHUNK):
+    return _chunked(_von_mises, (sx, sy, sz, syz, szx, sxy), 1, chunk)
+
+
+def _principal(sx, sy, sz, syz, szx, sxy):
+    tensors = np.empty((len(sx), 3, 3))
+    tensors[:, 0, 0], tensors[:, 1, 1], tensors[:, 2, 2] = sx, sy, sz
+    tensors[:, 1, 2] = tensors[:, 2, 1] = syz
+    tensors[:, 2, 0] = tensors[:, 0, 2] = szx
+    tensors[:, 0, 1] = tensors[:, 1, 0] = sxy
+    return np.linalg.eigvalsh(tensors)
+
+
+def principal(sx, sy, sz, syz, szx, sxy, chunk=DERIVED_CHUNK):
+    """
+    (N, 3) principal values in ascending order, by batched eigen solves of the 3x3 tensors
+    """
+    return _chunked(_principal, (sx, sy, sz, syz, szx, sxy), 3, chunk)
+
+
+def principal_outputs(values):
+    """
+    {type: values} of PRINCIPAL_STRESSES from the principal values of principal
+    """
+    high, low = values[:, 2], values[:, 0]
+    return {
+        vre.MAX_PRINCIPAL_STRESS: high,
+        vre.MIN_PRINCIPAL_STRESS: low,
+        # principal value of the largest magnitude, with its sign
+        vre.ABSOLUTE_PRINCIPAL_STRESS: np.where(np.abs(high) >= np.abs(low), high, low),
+    }
+
+
+def derivable(type):
+    return type in MAGNITUDES or type == vre.VON_MISES_STRESS or type in PRINCIPAL_STRESSES
+
+
+class DerivedCache:
+    """
+    LRU of derived outputs by (filename, kind, step), at most maxsize steps stay resident
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._steps = OrderedDict()
+
+    def outputs(self, filename, kind, step):
+        """
+        {type: values} memo of the node or voxel outputs of the step, created empty if missing
+        """
+        key = (filename, kind, step)
+        outputs = self._steps.get(key)
+        if outputs is None:
+            outputs = self._steps[key] = {}
+            while len(self._steps) > self.maxsize:
+                self._steps.popitem(last=False)
+        else:
+            self._steps.move_to_end(key)
+        return outputs
+
+    def __len__(self):
+        return len(self._steps)
+
+    def clear(self):
+        self._steps.clear()
+
+
+class DerivedResults:
+    """
+    Outputs of each step of the node or voxel datasets, read from the datasets or derived from their components
+
+    datasets are {model.ResultKey: values} of load_results, or
+    the datasets of model.ResultFile / store.ResultStore (values read by .values).
+    kind is "node" or "voxel", the datasets are node_datasets or voxel_datasets.
+    derived outputs are memoized in cache by (filename, kind, step), a cache may be shared by files.
+
+    derived = DerivedResults(result.filename, result.voxel_datasets, "voxel")
+    mises = derived.get(step, vre.VON_MISES_STRESS)
+    """
+
+    def __init__(self, filename, datasets, kind, cache=None, chunk=DERIVED_CHUNK):
+        if kind not in ("node", "voxel"):
+            raise Exception("unknown kind", kind)
+        self.filename = filename
+        self.datasets = datasets
+        self.kind = kind
+        self.cache = cache if cache is not None else DerivedCache()
+        self.chunk = chunk
+
+    def _find(self, step, type):
+        key = model.ResultKey(*step, type)
+        if key not in self.datasets:
+            return None
+        values = self.datasets[key]
+        return values if isinstance(values, np.ndarray) else values.values
+
+    def _component(self, step, type):
+        values = self._find(step, type)
+        if values is None:
+            raise Exception("component is not found", step, type)
+        return values
+
+    def get(self, step, type):
+        """
+        values of the type at the step (vre.Step), the dataset of the file if it has one
+        """
+        values = self._find(step, type)
+        if values is not None:
+            return values
+        if not derivable(type):
+            raise Exception("output is not found and can not be derived", step, type)
+        outputs = self.cache.outputs(self.filename, self.kind, step)
+        if type not in outputs:
+            if type in MAGNITUDES:
+                components = [self._component(step, t) for t in MAGNITUDES[type]]
+                outputs[type] = magnitude(*components, chunk=self.chunk)
+            else:
+                components = [self._component(step, t) for t in STRESS_COMPONENTS]
+                if type == vre.VON_MISES_STRESS:
+                    outputs[type] = von_mises(*components, chunk=self.chunk)
+                else:
+                    outputs.update(principal_outputs(principal(*components, chunk=self.chunk)))
+        return outputs[type]
@@ -1,5 +1,31 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
+from multiprocessing import shared_memory
+
+import numpy as np
+
 import vfe, vre
 
+# offset of each node from the voxel position, in the order of VoxelElement.node_ids (i j k l m n o p)
+NODE_OFFSETS = np.array([
+    (0, 0, 0),
+    (1, 0, 0),
+    (1, 1, 0),
+    (0, 1, 0),
+    (0, 0, 1),
+    (1, 0, 1),
+    (1, 1, 1),
+    (0, 1, 1),
+], dtype=np.int32)
+
 
 class VoxelElement:
     """
@@ -61,14 +87,307 @@ class VoxelElement:
         return self.__str__()
 
 
+class LazyList(Sequence):
+    """
+    Read only list creating the object of the index on access
+    """
+
+    def __init__(self, size, create):
+        self._size = size
+        self._create = create
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._create(j) for j in range(*i.indices(self._size))]
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError("index out of range", i)
+        return self._create(i)
+
+
+def position_bounds(pos):
+    """
+    (rows, origin, shape) of the rows with non negative position and their bounding box origin + [0, shape)
+    """
+    rows = np.flatnonzero((pos >= 0).all(axis=1))
+    valid = pos[rows].astype(np.int64)
+    if len(valid) > 0:
+        origin = valid.min(axis=0)
+        return rows, origin, valid.max(axis=0) - origin + 1
+    return rows, np.zeros(3, dtype=np.int64), np.zeros(3, dtype=np.int64)
+
+
+class PositionIndex(ABC):
+    """
+    Index from (x, y, z) position to the row of a (N, 3) position array
+
+    rows with negative position are not indexed.
+    the bounding box of the indexed positions is origin + [0, shape).
+    bounds is position_bounds(pos) when it is already computed.
+    """
+
+    def __init__(self, pos, bounds=None):
+        self.rows, self.origin, self.shape = bounds if bounds is not None else position_bounds(pos)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _inside(self, pos):
+        return ((pos >= self.origin) & (pos < self.origin + self.shape)).all(axis=1)
+
+    def _clip(self, start, stop):
+        # box relative to origin, clipped to the bounding box
+        lo = np.maximum(np.asarray(start, dtype=np.int64) - self.origin, 0)
+        hi = np.minimum(np.asarray(stop, dtype=np.int64) - self.origin, self.shape)
+        return lo, hi
+
+    @abstractmethod
+    def lookup(self, pos):
+        """
+        rows of the positions (M, 3), -1 for position not found
+        """
+
+    @abstractmethod
+    def query_box(self, start, stop):
+        """
+        rows of the positions in start <= pos < stop, in the order of (x, y, z)
+        """
+
+    def query_boxes(self, boxes):
+        """
+        rows inside each (start, stop) of boxes, returns (rows, offsets)
+
+        rows[offsets[i]:offsets[i + 1]] are inside boxes[i].
+        """
+        found = [self.query_box(start, stop) for start, stop in boxes]
+        offsets = np.zeros(len(found) + 1, dtype=np.int64)
+        np.cumsum([len(rows) for rows in found], out=offsets[1:])
+        return (np.concatenate(found) if found else np.empty(0, dtype=np.int64)), offsets
+
+
+class GridIndex(PositionIndex):
+    """
+    Dense int32 grid over the bounding box, -1 for empty cell
+
+    a batch of positions is looked up with one fancy indexing.
+    """
+
+    def __init__(self, pos, bounds=None):
+        super().__init__(pos, bounds)
+        self.grid = np.full(self.shape, -1, dtype=np.int32)
+        self.grid[tuple((pos[self.rows] - self.origin).T)] = self.rows
+
+    def lookup(self, pos):
+        pos = np.asarray(pos, dtype=np.int64).reshape(-1, 3)
+        inside = self._inside(pos)
+        found = np.full(len(pos), -1, dtype=np.int64)
+        found[inside] = self.grid[tuple((pos[inside] - self.origin).T)]
+        return found
+
+    def query_box(self, start, stop):
+        lo, hi = self._clip(start, stop)
+        if (hi <= lo).any():
+            return np.empty(0, dtype=np.int64)
+        cells = self.grid[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]].ravel()
+        return cells[cells >= 0].astype(np.int64)
+
+
+class SparseIndex(PositionIndex):
+    """
+    Positions linearized in the bounding box and searched in sorted order
+
+    used instead of GridIndex when most of the bounding box is empty.
+    """
+
+    def __init__(self, pos, bounds=None):
+        super().__init__(pos, bounds)
+        keys = self._keys(pos[self.rows].astype(np.int64))
+        order = np.argsort(keys, kind='stable')
+        self._keys_sorted = keys[order]
+        self.rows = self.rows[order]
+
+    def _keys(self, pos):
+        p = pos - self.origin
+        return (p[:, 0] * self.shape[1] + p[:, 1]) * self.shape[2] + p[:, 2]
+
+    def lookup(self, pos):
+        pos = np.asarray(pos, dtype=np.int64).reshape(-1, 3)
+        inside = self._inside(pos)
+        keys = self._keys(pos)
+        found = np.full(len(pos), -1, dtype=np.int64)
+        if len(self._keys_sorted) == 0:
+            return found
+        i = np.searchsorted(self._keys_sorted, keys)
+        i[i >= len(self._keys_sorted)] = 0
+        hit = inside & (self._keys_sorted[i] == keys)
+        found[hit] = self.rows[i[hit]]
+        return found
+
+    def query_box(self, start, stop):
+        lo, hi = self._clip(start, stop)
+        if (hi <= lo).any() or len(self._keys_sorted) == 0:
+            return np.empty(0, dtype=np.int64)
+        # keys of each (x, y) column of the box are one range in the sorted keys
+        x, y = np.meshgrid(np.arange(lo[0], hi[0]), np.arange(lo[1], hi[1]), indexing='ij')
+        base = (x.ravel() * self.shape[1] + y.ravel()) * self.shape[2]
+        first = np.searchsorted(self._keys_sorted, base + lo[2])
+        last = np.searchsorted(self._keys_sorted, base + hi[2])
+        counts = last - first
+        # concatenate the ranges first[i]:last[i]
+        i = np.repeat(first - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return self.rows[i].astype(np.int64)
+
+
+# minimum ratio of occupied cells to use GridIndex
+# 4 bytes per cell of the grid against 16 bytes per entry of SparseIndex
+GRID_MIN_OCCUPANCY = 0.25
+
+
+def create_position_index(pos, min_occupancy=GRID_MIN_OCCUPANCY):
+    bounds = position_bounds(pos)
+    rows, _, shape = bounds
+    cells = int(np.prod(shape))
+    if cells > 0 and len(rows) / cells >= min_occupancy:
+        return GridIndex(pos, bounds)
+    return SparseIndex(pos, bounds)
+
+
+class PositionMap(Mapping):
+    """
+    Read only dict from (x, y, z) position to the object created on access
+    """
+
+    def __init__(self, index, pos, create):
+        self._index = index
+        self._pos = pos
+        self._create = create
+
+    def _row(self, pos):
+        # -1 for the key not found, also for a key other than one (x, y, z) position as a dict would
+        try:
+            key = np.asarray(pos)
+        except (TypeError, ValueError):
+            return -1
+        if key.shape != (3,) or key.dtype.kind not in 'iuf':
+            return -1
+        if key.dtype.kind == 'f' and not (key == np.floor(key)).all():
+            return -1
+        return self._index.lookup(key)[0]
+
+    def __getitem__(self, pos):
+        row = self._row(pos)
+        if row < 0:
+            raise KeyError(pos)
+        return self._create(row)
+
+    def __contains__(self, pos):
+        return self._row(pos) >= 0
+
+    def __iter__(self):
+        return (tuple(p) for p in self._pos[np.sort(self._index.rows)].tolist())
+
+    def __len__(self):
+        return len(self._index)
+
+
 class VoxelMap:
+    """
+    Voxel elements held as columns
+
+    pos : (N, 3) position of each voxel
+    node_ids : (N, 8) node ids of each voxel in the order of VoxelElement.node_ids
+    prop_id : (N,) property id of each voxel
+
+    VoxelElement objects in elems and elems_map are created on access.
+    """
+
     def __init__(self, modelprp, voxels):
+        if not isinstance(voxels, np.ndarray):
+            # list of vfe.Voxcel
+            voxels = np.array(voxels, dtype=[(name, np.int64) for name in vfe.Voxcel._fields])
+        prop_id = voxels['prop_id'].astype(np.int32)
+        pos = np.stack([voxels['pos_x'], voxels['pos_y'], voxels['pos_z']], axis=1).astype(np.int32)
+        nodes = np.stack([voxels['node_1'], voxels['node_2'], voxels['node_3'], voxels['node_4']],
+                         axis=1).astype(np.int32)
+        diffs = np.stack([voxels['node_diff_1'], voxels['node_diff_2'], voxels['node_diff_3'], voxels['node_diff_4']],
+                         axis=1).astype(np.int32)
+        self._init(modelprp, prop_id, pos, np.concatenate([nodes, nodes + diffs], axis=1))
+
+    @classmethod
+    def from_arrays(cls, modelprp, prop_id, pos, node_ids):
+        """
+        VoxelMap over the columns of another VoxelMap, the arrays are used without copy
+        """
+        self = cls.__new__(cls)
+        self._init(modelprp, prop_id, pos, node_ids)
+        return self
+
+    def _init(self, modelprp, prop_id, pos, node_ids):
         self._modelprp = modelprp
         self.num_node = modelprp.num_node
         self.size = (modelprp.size_x, modelprp.size_y, modelprp.size_z)
         self.num = (modelprp.num_x, modelprp.num_y, modelprp.num_z)
-        self.elems = [VoxelElement(i, elem) for i, elem in enumerate(voxels)]
-        self.elems_map = {elem.pos: elem for elem in self.elems}
+        self.prop_id = prop_id
+        self.pos = pos
+        self.node_ids = node_ids
+        self.elems = LazyList(len(self.pos), self.elem)
+        self._index = None
+        self._transfer = None
+
+    @property
+    def index(self):
+        # built on first use, a model loaded from the cache may never look up positions
+        if self._index is None:
+            self._index = create_position_index(self.pos)
+        return self._index
+
+    @property
+    def elems_map(self):
+        return PositionMap(self.index, self.pos, self.elem)
+
+    @property
+    def transfer(self):
+        # NodeElementTransfer of the model, built on first use and shared by every step and type
+        if self._transfer is None:
+            self._transfer = NodeElementTransfer(self)
+        return self._transfer
+
+    def __len__(self):
+        return len(self.pos)
+
+    def lookup(self, pos):
+        """
+        voxel indices of the positions (M, 3), -1 for position without voxel
+        """
+        return self.index.lookup(pos)
+
+    def query_box(self, start, stop):
+        """
+        voxel indices inside start <= pos < stop (grid coordinates, stop exclusive)
+
+        takes time of the size of the box, not of the model.
+        values of the region are values[indices] for the arrays of load_results / ResultStore,
+        or MappedResult.take(output, indices).
+        """
+        return self.index.query_box(start, stop)
+
+    def query_boxes(self, boxes):
+        """
+        voxel indices inside each (start, stop) of boxes, returns (indices, offsets)
+
+        indices[offsets[i]:offsets[i + 1]] are inside boxes[i].
+        """
+        return self.index.query_boxes(boxes)
+
+    def elem(self, i):
+        pos = self.pos[i].tolist()
+        node_ids = self.node_ids[i].tolist()
+        diffs = [node_ids[4 + k] - node_ids[k] for k in range(4)]
+        return VoxelElement(i, vfe.Voxcel(int(self.prop_id[i]), *pos, *node_ids[:4], *diffs))
 
 
 class Node:
@@ -94,33 +413,277 @@ class Node:
         return self.__str__()
 
 
+class NodePositionError(Exception):
+    """
+    Nodes shared by voxels which do not agree on the node position
+
+    node_ids holds every conflicting node id.
+    """
+
+    def __init__(self, node_ids):
+        super().__init__("pos is not match", len(node_ids), node_ids.tolist()[:10])
+        self.node_ids = node_ids
+
+
 class NodeMap:
+    """
+    Node positions held as columns
+
+    pos : (M, 3) position of each node by index (node id - 1), -1 for node not used by any voxel
+
+    Node objects in nodes and nodes_map are created on access.
+    """
+
+    def __init__(self, voxelmap):
+        self.num_node = voxelmap.num_node
+        self.pos = np.full((self.num_node, 3), -1, dtype=np.int32)
+        if len(voxelmap) > 0:
+            low, high = voxelmap.node_ids.min(), voxelmap.node_ids.max()
+            if low < 1 or high > self.num_node:
+                raise Exception("node id is out of range", int(low), int(high), self.num_node)
+        # scatter the position of every corner, a node given different positions
+        # keeps only one of them and the others are found by gathering back
+        for corner, offset in enumerate(NODE_OFFSETS):
+            self.pos[voxelmap.node_ids[:, corner] - 1] = voxelmap.pos + offset
+        conflicts = []
+        for corner, offset in enumerate(NODE_OFFSETS):
+            idx = voxelmap.node_ids[:, corner] - 1
+            mismatch = (self.pos[idx] != voxelmap.pos + offset).any(axis=1)
+            conflicts.append(idx[mismatch])
+        conflicts = np.unique(np.concatenate(conflicts))
+        if len(conflicts) > 0:
+            raise NodePositionError(conflicts + 1)
+        self._init()
+
+    @classmethod
+    def from_arrays(cls, pos):
+        """
+        NodeMap over the positions of another NodeMap, the array is used without copy
+        """
+        self = cls.__new__(cls)
+        self.num_node = len(pos)
+        self.pos = pos
+        self._init()
+        return self
+
+    def _init(self):
+        self.nodes = LazyList(self.num_node, self.node)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = create_position_index(self.pos)
+        return self._index
+
+    @property
+    def nodes_map(self):
+        return PositionMap(self.index, self.pos, self.node)
+
+    def __len__(self):
+        return self.num_node
+
+    def lookup(self, pos):
+        """
+        node indices (node id - 1) of the positions (M, 3), -1 for position without node
+        """
+        return self.index.lookup(pos)
+
+    def query_box(self, start, stop):
+        """
+        node indices (node id - 1) inside start <= pos < stop (grid coordinates, stop exclusive)
+
+        takes time of the size of the box, not of the model.
+        values of the region are values[indices] for the arrays of load_results / ResultStore,
+        or MappedResult.take(output, indices).
+        """
+        return self.index.query_box(start, stop)
+
+    def query_boxes(self, boxes):
+        """
+        node indices (node id - 1) inside each (start, stop) of boxes, returns (indices, offsets)
+
+        indices[offsets[i]:offsets[i + 1]] are inside boxes[i].
+        """
+        return self.index.query_boxes(boxes)
+
+    def node(self, idx):
+        node = Node(idx)
+        if self.pos[idx, 0] >= 0:
+            node.save(tuple(self.pos[idx].tolist()))
+        return node
+
+
+class NodeElementTransfer:
+    """
+    Averaging between node values and voxel values of one model
+
+    the connectivity of voxelmap.node_ids is kept as flat indices with the
+    valence (number of voxels) of each node, so one operator serves every step and type.
+    values are (num_node,) / (N,) or with a trailing axis of columns, (num_node, k) / (N, k).
+
+    to_elem : mean of the 8 corners of each voxel
+    to_node : mean of the voxels sharing each node, nan for node not used by any voxel
+    """
+
     def __init__(self, voxelmap):
         self.num_node = voxelmap.num_node
-        self.nodes = [Node(i) for i in range(self.num_node)]
-        for elem in voxelmap.elems:
-            for id, pos in zip(elem.node_ids, elem.node_pos()):
-                self.nodes[id - 1].save(pos)
-        self.nodes_map = {node.pos: node for node in self.nodes}
+        self.corners = np.asarray(voxelmap.node_ids, dtype=np.int64) - 1
+        self._flat = self.corners.ravel()
+        self.valence = np.bincount(self._flat, minlength=self.num_node)
+
+    def to_elem(self, node_values):
+        node_values = np.asarray(node_values)
+        if len(node_values) != self.num_node:
+            raise Exception("number of node values not match", len(node_values), self.num_node)
+        return node_values[self.corners].mean(axis=1)
+
+    def to_node(self, elem_values):
+        elem_values = np.asarray(elem_values)
+        if len(elem_values) != len(self.corners):
+            raise Exception("number of voxel values not match", len(elem_values), len(self.corners))
+        dtype = elem_values.dtype if elem_values.dtype.kind == 'f' else np.float64
+        columns = elem_values.reshape(len(elem_values), -1)
+        nodes = np.empty((self.num_node, columns.shape[1]), dtype=dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for k in range(columns.shape[1]):
+                # every voxel adds its value to its 8 nodes
+                sums = np.bincount(self._flat, weights=np.repeat(columns[:, k], 8), minlength=self.num_node)
+                nodes[:, k] = sums / self.valence
+        return nodes.reshape((self.num_node,) + elem_values.shape[1:])
+
+
+def detail_area_box(area):
+    """
+    (start, stop) box of vre.DetailArea for query_box
+    """
+    start = (area.start_pos_x, area.start_pos_y, area.start_pos_z)
+    return start, (start[0] + area.nvox_x, start[1] + area.nvox_y, start[2] + area.nvox_z)
 
 
 def load_voxel_map(vfe_filename):
-    with open(vfe_filename, "rb") as f:
-        byteorder, header, version = vfe.decode_header(f)
-        ctx = vfe.Context(byteorder, header.size_of_int, header.size_of_real)
-        buf = ctx.next_record(f)
-        modelprp, element, voxels = None, None, None
-        while buf is not None:
-            recid = vfe.decode_recid(ctx, ctx.unwrap_record(buf))
-            if recid == vfe.ModelPrpId:
-                modelprp = vfe.decode_modelprp(ctx, ctx.unwrap_record(buf))
-            elif recid == vfe.ElementId:
-                element, voxels = vfe.decode_element(ctx, ctx.unwrap_record(buf))
-            buf = ctx.next_record(f)
-    voxelmap = VoxelMap(modelprp, voxels)
+    modelprp, voxelmap = None, None
+    for record in vfe.iter_records(vfe_filename, recids=(vfe.ModelPrpId, vfe.ElementId)):
+        if record.recid == vfe.ModelPrpId:
+            modelprp = record.decode()
+        elif record.recid == vfe.ElementId:
+            # voxels are a view of the file, VoxelMap copies the columns before the file is unmapped
+            voxelmap = VoxelMap(modelprp, record.decode(as_array=True)[1])
     return voxelmap
 
 
+# ================================
+# モデルキャッシュ
+# ================================
+
+# directory of the model cache, VRE_PARSER_CACHE overrides it
+MODEL_CACHE_DIR = os.environ.get("VRE_PARSER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "vre_parser"))
+# total size of the cache entries, least recently used entries are removed above it
+MODEL_CACHE_MAX_BYTES = 4 << 30
+# bump when the layout of a cache entry changes
+MODEL_CACHE_VERSION = 1
+# bytes read from the head and the tail of the .vfe for the key
+MODEL_CACHE_HASH_BYTES = 1 << 20
+
+# arrays of a cache entry, stored as <name>.npy
+ModelArrays = ('prop_id', 'pos', 'node_ids', 'node_pos')
+
+
+def record_to_json(record):
+    """
+    dict of the namedtuple for json, bytes are decoded as latin-1 so every byte is kept
+    """
+    return {k: v.decode('latin-1') if isinstance(v, bytes) else v for k, v in record._asdict().items()}
+
+
+def record_from_json(model, obj):
+    # records have no str field, every str is bytes stored by record_to_json
+    return model._make(obj[k].encode('latin-1') if isinstance(obj[k], str) else obj[k] for k in model._fields)
+
+
+def model_cache_key(vfe_filename):
+    """
+    key from the size, the mtime and the hash of the head and the tail of the file
+    """
+    st = os.stat(vfe_filename)
+    h = hashlib.blake2b(digest_size=16)
+    h.update('{}:{}:{}'.format(MODEL_CACHE_VERSION, st.st_size, st.st_mtime_ns).encode())
+    with open(vfe_filename, "rb") as f:
+        h.update(f.read(MODEL_CACHE_HASH_BYTES))
+        if st.st_size > MODEL_CACHE_HASH_BYTES:
+            f.seek(max(MODEL_CACHE_HASH_BYTES, st.st_size - MODEL_CACHE_HASH_BYTES))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _load_model_entry(entry):
+    with open(os.path.join(entry, "modelprp.json"), "r") as f:
+        modelprp = record_from_json(vfe.ModelPrp, json.load(f))
+    prop_id, pos, node_ids, node_pos = [np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+                                        for name in ModelArrays]
+    return VoxelMap.from_arrays(modelprp, prop_id, pos, node_ids), NodeMap.from_arrays(node_pos)
+
+
+def _save_model_entry(cache_dir, entry, vfe_filename, voxelmap, nodemap):
+    # written to a temporary directory and renamed, a reader never sees a partial entry
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for name, arr in zip(ModelArrays, (voxelmap.prop_id, voxelmap.pos, voxelmap.node_ids, nodemap.pos)):
+            np.save(os.path.join(tmp, name + ".npy"), arr)
+        with open(os.path.join(tmp, "modelprp.json"), "w") as f:
+            json.dump(record_to_json(voxelmap._modelprp), f)
+        with open(os.path.join(tmp, "source.txt"), "w") as f:
+            f.write(os.path.abspath(vfe_filename))
+        os.rename(tmp, entry)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(entry):
+            raise
+
+
+def evict_model_cache(cache_dir=None, max_bytes=MODEL_CACHE_MAX_BYTES, keep=None):
+    """
+    remove least recently used entries until the cache is at most max_bytes, keep is never removed
+    """
+    cache_dir = cache_dir or MODEL_CACHE_DIR
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry):
+            continue
+        size = sum(e.stat().st_size for e in os.scandir(entry) if e.is_file())
+        entries.append((os.stat(entry).st_mtime, size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def load_model(vfe_filename, cache_dir=None, max_bytes=MODEL_CACHE_MAX_BYTES):
+    """
+    (voxelmap, nodemap) of the .vfe, loaded from the cache when the file is unchanged
+
+    the arrays of a cached model are read only np.memmap of the .npy files.
+    """
+    cache_dir = cache_dir or MODEL_CACHE_DIR
+    entry = os.path.join(cache_dir, model_cache_key(vfe_filename))
+    if os.path.isdir(entry):
+        # mtime of the entry is its last use for evict_model_cache
+        os.utime(entry)
+        return _load_model_entry(entry)
+    voxelmap = load_voxel_map(vfe_filename)
+    nodemap = NodeMap(voxelmap)
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_model_entry(cache_dir, entry, vfe_filename, voxelmap, nodemap)
+    evict_model_cache(cache_dir, max_bytes, keep=entry)
+    return voxelmap, nodemap
+
+
 class OutputValue:
     def __init__(self, type, value, origin):
         self.type = type
@@ -138,23 +701,318 @@ class OutputValue:
 def load_outputs(vre_filename, voxelmap, nodemap, types=None):
     node_outputs = {}
     voxel_outputs = {}
+    for record in vre.iter_records(vre_filename, recids=(vre.NodeValId, vre.ElemValId)):
+        _, outputs = record.decode(types=types)
+        if record.recid == vre.NodeValId:
+            for output, values in outputs:
+                node_outputs[output.type] = [OutputValue(output.type, value, node) for value, node in
+                                             zip(values, nodemap.nodes)]
+        else:
+            for output, values in outputs:
+                voxel_outputs[output.type] = [OutputValue(output.type, value, elem) for value, elem in
+                                              zip(values, voxelmap.elems)]
+    return voxel_outputs, node_outputs
+
+
+def check_count(output, values, size):
+    if len(values) != size:
+        raise Exception("number of values not match", output.type, len(values), size)
+
+
+def load_output_arrays(vre_filename, voxelmap, nodemap, types=None):
+    """
+    load outputs as {type: values} for voxels and for nodes
+
+    values is numpy array in native byteorder aligned with the columns of
+    voxelmap / nodemap, values[i] is the value of voxelmap.pos[i] / nodemap.pos[i].
+    """
+    node_outputs = {}
+    voxel_outputs = {}
+    for record in vre.iter_records(vre_filename, recids=(vre.NodeValId, vre.ElemValId)):
+        if record.recid == vre.NodeValId:
+            arrays, size = node_outputs, nodemap.num_node
+        else:
+            arrays, size = voxel_outputs, len(voxelmap)
+        # copies in native byteorder, no view of the file is left when it is unmapped
+        for output, values in decode_values(record.ctx, record.recid, record.read(), types):
+            check_count(output, values, size)
+            arrays[output.type] = values
+    return voxel_outputs, node_outputs
+
+
+# key of the results of load_results, vre.Step fields and the output type
+ResultKey = namedtuple('ResultKey', vre.Step._fields + ('type',))
+
+
+def result_steps(*datasets):
+    """
+    vre.Step of the keys of {ResultKey: ...} datasets, in the order of appearance
+    """
+    return list(dict.fromkeys(vre.Step(*key[:-1]) for keys in datasets for key in keys))
+
+
+def result_types(*datasets):
+    """
+    sorted output types of the keys of {ResultKey: ...} datasets
+    """
+    return sorted({key.type for keys in datasets for key in keys})
+
+
+def select_step(step, steps=None, time_range=None, modes=None, subcases=None):
+    """
+    steps : i_step to load
+    time_range : (start, end) of time to load, both inclusive
+    modes : mode_id to load
+    subcases : subcase_id to load
+
+    data without DataProp (step is None) is selected only without any condition
+    """
+    if step is None:
+        return steps is None and time_range is None and modes is None and subcases is None
+    if steps is not None and step.i_step not in steps:
+        return False
+    if time_range is not None and not time_range[0] <= step.time <= time_range[1]:
+        return False
+    if modes is not None and step.mode_id not in modes:
+        return False
+    if subcases is not None and step.subcase_id not in subcases:
+        return False
+    return True
+
+
+def decode_values(ctx, recid, buf, types=None):
+    """
+    decode NodeVal / ElemVal record as [(output, values)], values in native byteorder
+    """
+    if recid == vre.NodeValId:
+        _, outputs = vre.decode_nodeval(ctx, buf, as_array=True, types=types)
+    else:
+        _, outputs = vre.decode_elemval(ctx, buf, as_array=True, types=types)
+    return [(output, vre.to_native(values)) for output, values in outputs]
+
+
+def _decode_values_file(vre_filename, layout, recid, offset, length, types):
+    # decode_values in the worker process, the record is read here instead of being sent
+    with open(vre_filename, "rb") as f:
+        f.seek(offset)
+        buf = f.read(length)
+    return decode_values(vre.Context(*layout), recid, buf, types)
+
+
+def load_results(vre_filename, voxelmap, nodemap, types=None, steps=None, time_range=None, modes=None,
+                 subcases=None, max_workers=1, processes=False):
+    """
+    load outputs of every step as {ResultKey: values} for voxels and for nodes
+
+    records of steps not selected by select_step are not decoded.
+    values are numpy arrays as load_output_arrays, keys are in the order of the file.
+
+    the record boundaries are found first, then the selected records are decoded
+    by max_workers threads (processes if processes is True), 1 decodes in this thread.
+    """
+    node_results = {}
+    voxel_results = {}
     with open(vre_filename, "rb") as f:
         byteorder, header, version = vre.decode_header(f)
         ctx = vre.Context(byteorder, header.size_of_int, header.size_of_real)
-        buf = ctx.next_record(f)
+        with vre.RecordReader(ctx, f) as reader:
+            # (step, recid, offset, buf) of the records to decode
+            blocks = []
+            step = None
+            selected = select_step(step, steps, time_range, modes, subcases)
+            buf = reader.next_record()
+            while buf is not None:
+                recid = vre.decode_recid(ctx, buf)
+                if recid == vre.DataPropId:
+                    step = vre.dataprop_step(vre.decode_dataprop(ctx, buf))
+                    selected = select_step(step, steps, time_range, modes, subcases)
+                elif selected and recid in (vre.NodeValId, vre.ElemValId):
+                    blocks.append((step, recid, reader.offset + ctx.size_of_int, buf))
+                buf = reader.next_record()
+
+            if max_workers == 1:
+                decoded = (decode_values(ctx, recid, buf, types) for _, recid, _, buf in blocks)
+                executor = None
+            elif processes:
+                executor = ProcessPoolExecutor(max_workers)
+                decoded = executor.map(_decode_values_file, repeat(vre_filename),
+                                       repeat((byteorder, header.size_of_int, header.size_of_real)),
+                                       [recid for _, recid, _, _ in blocks], [offset for _, _, offset, _ in blocks],
+                                       [len(buf) for _, _, _, buf in blocks], repeat(types))
+            else:
+                # numpy releases the GIL while byteswapping and copying the values
+                executor = ThreadPoolExecutor(max_workers)
+                decoded = executor.map(lambda block: decode_values(ctx, block[1], block[3], types), blocks)
+            try:
+                # map keeps the order of the file, the buffers of blocks are not bound here
+                for (step, recid), outputs in zip([block[:2] for block in blocks], decoded):
+                    if recid == vre.NodeValId:
+                        results, size = node_results, nodemap.num_node
+                    else:
+                        results, size = voxel_results, len(voxelmap)
+                    for output, values in outputs:
+                        check_count(output, values, size)
+                        key = ResultKey(*(step or vre.Step(None, None, None, None, None)), output.type)
+                        results[key] = values
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+            # the views of the records are dropped here so that closing the reader unmaps the file,
+            # decoded still refers to the last buffer when the loop ends before it is exhausted
+            del blocks, decoded
+    return voxel_results, node_results
+
+
+class ResultFile:
+    """
+    Datasets of every step of the .vre, decoded on access
+
+    node_datasets / voxel_datasets are {ResultKey: vre.Dataset} in the order of the file.
+    the file stays mapped until close, at most cache_size decoded datasets stay resident.
+    the datasets are removed by close, values still held by the caller keep the file mapped.
+
+    with ResultFile("result.vre") as result:
+        values = result.voxel_datasets[key].values
+    """
+
+    def __init__(self, vre_filename, types=None, cache_size=8):
+        self.filename = vre_filename
+        self.cache = vre.DatasetCache(cache_size)
+        self.node_datasets = {}
+        self.voxel_datasets = {}
+        with open(vre_filename, "rb") as f:
+            byteorder, self.header, self.version = vre.decode_header(f)
+            self.ctx = vre.Context(byteorder, self.header.size_of_int, self.header.size_of_real)
+            self._reader = vre.RecordReader(self.ctx, f)
+        step = None
+        buf = self._reader.next_record()
         while buf is not None:
-            recid = vre.decode_recid(ctx, ctx.unwrap_record(buf))
-            if recid == vre.NodeValId:
-                _, outputs = vre.decode_nodeval(ctx, ctx.unwrap_record(buf))
-                for output, values in outputs:
-                    if types is None or output.type in types:
-                        node_outputs[output.type] = [OutputValue(output.type, value, node) for value, node in
-                                                     zip(values, nodemap.nodes)]
-            elif recid == vre.ElemValId:
-                _, outputs = vre.decode_elemval(ctx, ctx.unwrap_record(buf))
-                for output, values in outputs:
-                    if types is None or output.type in types:
-                        voxel_outputs[output.type] = [OutputValue(output.type, value, elem) for value, elem in
-                                                      zip(values, voxelmap.elems)]
-            buf = ctx.next_record(f)
-    return voxel_outputs, node_outputs
+            recid = vre.decode_recid(self.ctx, buf)
+            if recid == vre.DataPropId:
+                step = vre.dataprop_step(vre.decode_dataprop(self.ctx, buf))
+            elif recid in (vre.NodeValId, vre.ElemValId):
+                if recid == vre.NodeValId:
+                    _, outputs = vre.decode_nodeval(self.ctx, buf, types=types, lazy=True)
+                    datasets = self.node_datasets
+                else:
+                    _, outputs = vre.decode_elemval(self.ctx, buf, types=types, lazy=True)
+                    datasets = self.voxel_datasets
+                for output, dataset in outputs:
+                    dataset.cache = self.cache
+                    datasets[ResultKey(*(step or vre.Step(None, None, None, None, None)), output.type)] = dataset
+            buf = self._reader.next_record()
+
+    def steps(self):
+        return result_steps(self.node_datasets, self.voxel_datasets)
+
+    def types(self):
+        return result_types(self.node_datasets, self.voxel_datasets)
+
+    def close(self):
+        self.cache.clear()
+        # every dataset holds a view of the mapping, the mapping is not closed while one is alive
+        for datasets in (self.node_datasets, self.voxel_datasets):
+            for dataset in datasets.values():
+                dataset.buf = None
+            datasets.clear()
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# ================================
+# 複数ファイルの読み込み
+# ================================
+
+def model_filename(vre_filename):
+    """
+    path of the .vfe model named in Baseinfo of the .vre, relative to the .vre
+    """
+    for record in vre.iter_records(vre_filename, recids=(vre.BaseinfoId,)):
+        baseinfo = record.decode()
+        name = os.fsdecode(baseinfo.vfe_filename.split(b'\0', 1)[0].rstrip())
+        return os.path.join(os.path.dirname(vre_filename), name)
+    raise Exception("baseinfo is not found", vre_filename)
+
+
+def share_array(arr):
+    """
+    copy arr into a new shared memory block, returns the block and the spec to attach it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_array(spec):
+    """
+    array of the shared memory block shared by share_array, returns the block and the array
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# model of the worker process, set once by _init_worker
+_worker_model = None
+
+
+def _init_worker(modelprp, specs):
+    global _worker_model
+    blocks, arrays = zip(*[attach_array(spec) for spec in specs])
+    prop_id, pos, node_ids, node_pos = arrays
+    voxelmap = VoxelMap.from_arrays(modelprp, prop_id, pos, node_ids)
+    nodemap = NodeMap.from_arrays(node_pos)
+    # the blocks are kept alive as long as the arrays are used
+    _worker_model = (blocks, voxelmap, nodemap)
+
+
+def _load_worker(vre_filename, types, select):
+    _, voxelmap, nodemap = _worker_model
+    return load_results(vre_filename, voxelmap, nodemap, types, **select)
+
+
+def load_batch(vre_filenames, voxelmap=None, nodemap=None, types=None, max_workers=None, **select):
+    """
+    load_results of many .vre files sharing one model in worker processes
+
+    the model is loaded from Baseinfo of the first file when voxelmap is not given.
+    its arrays are passed to each worker once through shared memory, only the
+    file name is sent per task.
+    select is steps, time_range, modes and subcases of load_results.
+
+    yields (vre_filename, voxel_results, node_results) in the order the files are finished.
+    """
+    vre_filenames = list(vre_filenames)
+    if len(vre_filenames) == 0:
+        return
+    if voxelmap is None:
+        voxelmap = load_voxel_map(model_filename(vre_filenames[0]))
+    if nodemap is None:
+        nodemap = NodeMap(voxelmap)
+    blocks, specs = [], []
+    try:
+        for arr in (voxelmap.prop_id, voxelmap.pos, voxelmap.node_ids, nodemap.pos):
+            shm, spec = share_array(np.ascontiguousarray(arr))
+            blocks.append(shm)
+            specs.append(spec)
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                 initargs=(voxelmap._modelprp, specs)) as executor:
+            futures = {executor.submit(_load_worker, filename, types, select): filename
+                       for filename in vre_filenames}
+            try:
+                for future in as_completed(futures):
+                    voxel_results, node_results = future.result()
+                    yield futures[future], voxel_results, node_results
+            finally:
+                # files not started yet are dropped when the caller stops early
+                for future in futures:
+                    future.cancel()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,200 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import model
+
+# ================================
+# 縮約ピラミッド
+# ================================
+
+# block factors built by default, each level is built from the previous one
+PYRAMID_FACTORS = (2, 4, 8)
+
+Level = namedtuple('Level', [
+    # ブロック倍率 : a cell of the level is factor^3 voxels
+    'factor',
+
+    # 値を持つセルの位置 (K, 3), floor(voxel position / factor)
+    'pos',
+
+    # セル内の平均値
+    'mean',
+
+    # セル内の最大値
+    'max',
+
+    # セル内のボクセル数, occupancy is count / factor^3
+    'count',
+])
+
+
+def _aggregate(pos, sums, maxs, counts, ratio, factor):
+    # merge cells of pos into cells of pos // ratio with one sort
+    cells = pos.astype(np.int64) // ratio
+    if len(cells) == 0:
+        return Level(factor, np.empty((0, 3), dtype=np.int32), np.empty(0), np.empty(0),
+                     np.empty(0, dtype=np.int64))
+    low = cells.min(axis=0)
+    shape = cells.max(axis=0) - low + 1
+    c = cells - low
+    keys = (c[:, 0] * shape[1] + c[:, 1]) * shape[2] + c[:, 2]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    total = np.add.reduceat(sums[order], starts)
+    count = np.add.reduceat(counts[order], starts)
+    return Level(factor, cells[order[starts]].astype(np.int32), total / count,
+                 np.maximum.reduceat(maxs[order], starts), count)
+
+
+def downsample(pos, values, factor):
+    """
+    Level of the voxel values (N,) at the voxel positions (N, 3)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return _aggregate(pos, values, values, np.ones(len(values), dtype=np.int64), factor, factor)
+
+
+def coarsen(level, factor):
+    """
+    Level of factor built from the finer level, factor must be a multiple of level.factor
+    """
+    if factor % level.factor != 0:
+        raise Exception("factor is not a multiple of the level", factor, level.factor)
+    return _aggregate(level.pos, level.mean * level.count, level.max, level.count, factor // level.factor, factor)
+
+
+def build_pyramid(pos, values, factors=PYRAMID_FACTORS):
+    """
+    [Level] of each factor, a level is coarsened from the previous level when its factor divides
+    """
+    levels = []
+    for factor in factors:
+        if levels and factor % levels[-1].factor == 0:
+            levels.append(coarsen(levels[-1], factor))
+        else:
+            levels.append(downsample(pos, values, factor))
+    return levels
+
+
+def dense(level, fill=np.nan):
+    """
+    (origin, mean, max, occupancy) as dense arrays over the bounding box of the level
+    """
+    if len(level.pos) == 0:
+        empty = np.empty((0, 0, 0))
+        return np.zeros(3, dtype=np.int64), empty, empty, empty
+    origin = level.pos.min(axis=0).astype(np.int64)
+    shape = tuple(level.pos.max(axis=0) - origin + 1)
+    cells = tuple((level.pos - origin).T)
+    arrays = []
+    for values in (level.mean, level.max, level.count / level.factor ** 3):
+        a = np.full(shape, fill, dtype=np.float64)
+        a[cells] = values
+        arrays.append(a)
+    return (origin, *arrays)
+
+
+def build_result_pyramids(vre_filename, voxelmap, types=None, factors=PYRAMID_FACTORS):
+    """
+    {model.ResultKey: [Level]} of every voxel dataset of the .vre
+
+    datasets are decoded one at a time.
+    """
+    pyramids = {}
+    with model.ResultFile(vre_filename, types=types) as result:
+        for key, dataset in result.voxel_datasets.items():
+            model.check_count(dataset.output, dataset, len(voxelmap))
+            # the decoded view is not kept, so the file is unmapped when result is closed
+            pyramids[key] = build_pyramid(voxelmap.pos, dataset.decode(), factors)
+    return pyramids
+
+
+# ================================
+# キャッシュ
+# ================================
+#
+# npz next to the .vre, members are
+#   source : size and mtime_ns of the .vre
+#   params : json of types and factors it was built with
+#   keys   : json of the keys
+#   <n>/<factor>/<field> : Level field of the n-th key
+
+def pyramid_filename(vre_filename):
+    return vre_filename + ".pyr.npz"
+
+
+def _source(vre_filename):
+    st = os.stat(vre_filename)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def _params(types, factors):
+    return json.dumps({"types": None if types is None else sorted(types), "factors": list(factors)})
+
+
+def save_pyramids(vre_filename, pyramids, filename=None, types=None, factors=PYRAMID_FACTORS):
+    members = {
+        "source": _source(vre_filename),
+        "params": np.array(_params(types, factors)),
+        "keys": np.array(json.dumps([list(key) for key in pyramids])),
+    }
+    for n, levels in enumerate(pyramids.values()):
+        for level in levels:
+            for field in Level._fields[1:]:
+                members["{}/{}/{}".format(n, level.factor, field)] = getattr(level, field)
+    filename = filename or pyramid_filename(vre_filename)
+    # np.savez appends .npz to other names
+    tmp = filename + ".tmp.npz"
+    np.savez(tmp, **members)
+    os.replace(tmp, filename)
+
+
+class PyramidFile:
+    """
+    Levels cached by save_pyramids, each level is read from the npz on access
+    """
+
+    def __init__(self, vre_filename, filename=None):
+        self._npz = np.load(filename or pyramid_filename(vre_filename))
+        self.stale = not np.array_equal(self._npz["source"], _source(vre_filename))
+        self.params = self._npz["params"].item()
+        self._keys = {model.ResultKey(*key): n for n, key in enumerate(json.loads(self._npz["keys"].item()))}
+
+    def keys(self):
+        return list(self._keys)
+
+    def factors(self, key):
+        prefix = "{}/".format(self._keys[key])
+        return sorted({int(name.split("/")[1]) for name in self._npz.files if name.startswith(prefix)})
+
+    def level(self, key, factor):
+        prefix = "{}/{}/".format(self._keys[key], factor)
+        return Level(factor, *[self._npz[prefix + field] for field in Level._fields[1:]])
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_pyramids(vre_filename, voxelmap, types=None, factors=PYRAMID_FACTORS, filename=None):
+    """
+    PyramidFile of the .vre, built and saved next to it when missing, stale or built for other types / factors
+    """
+    filename = filename or pyramid_filename(vre_filename)
+    if os.path.exists(filename):
+        pyramids = PyramidFile(vre_filename, filename)
+        if not pyramids.stale and pyramids.params == _params(types, factors):
+            return pyramids
+        pyramids.close()
+    save_pyramids(vre_filename, build_result_pyramids(vre_filename, voxelmap, types, factors), filename, types,
+                  factors)
+    return PyramidFile(vre_filename, filename)
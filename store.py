@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import model
+import vre
+
+# ================================
+# 結果ストア
+# ================================
+#
+# directory of the datasets of a .vre converted by convert
+#
+#   manifest.json : records of the .vre and the list of the datasets
+#   000000.bin    : values of each dataset, raw array in native byteorder
+#
+# a store is written into a temporary directory next to it and renamed into place,
+# an existing store is replaced as a whole and never left half written.
+
+MANIFEST = "manifest.json"
+
+# bump when the layout of the store changes
+STORE_VERSION = 1
+
+
+def dataset_filename(i):
+    return "{:06d}.bin".format(i)
+
+
+def load_record(model_type, obj):
+    return None if obj is None else model.record_from_json(model_type, obj)
+
+
+def convert(vre_filename, store_dir, types=None):
+    """
+    write every dataset of the .vre into store_dir, returns the number of datasets
+
+    types : output types to store, every type if None
+    store_dir must not exist, be empty or be a store, which is replaced.
+    """
+    if os.path.isdir(store_dir) and os.listdir(store_dir) and \
+            not os.path.exists(os.path.join(store_dir, MANIFEST)):
+        raise Exception("directory is not a store", store_dir)
+    parent = os.path.dirname(os.path.abspath(store_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".store-", dir=parent)
+    try:
+        # mkdtemp creates the directory readable only by the owner
+        os.chmod(tmp_dir, 0o755)
+        n = _write_store(vre_filename, tmp_dir, types)
+        if os.path.isdir(store_dir):
+            old_dir = tmp_dir + ".old"
+            os.replace(store_dir, old_dir)
+            os.replace(tmp_dir, store_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, store_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return n
+
+
+def _write_store(vre_filename, store_dir, types):
+    manifest = {
+        "version": STORE_VERSION,
+        "source": None,
+        "header": None,
+        "title": None,
+        "param": None,
+        "baseinfo": None,
+        "rscases": [],
+        "dataprops": [],
+        "datasets": [],
+    }
+    st = os.stat(vre_filename)
+    manifest["source"] = {"filename": os.path.abspath(vre_filename), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with open(vre_filename, "rb") as f:
+        byteorder, header, version = vre.decode_header(f)
+        ctx = vre.Context(byteorder, header.size_of_int, header.size_of_real)
+        manifest["header"] = {"byteorder": byteorder, "header": model.record_to_json(header),
+                              "version": model.record_to_json(version)}
+        with vre.RecordReader(ctx, f) as reader:
+            dataprop = None
+            buf = reader.next_record()
+            while buf is not None:
+                recid = vre.decode_recid(ctx, buf)
+                if recid == vre.TitleId:
+                    manifest["title"] = model.record_to_json(vre.decode_title(ctx, buf))
+                elif recid == vre.ParamId:
+                    manifest["param"] = model.record_to_json(vre.decode_param(ctx, buf))
+                elif recid == vre.BaseinfoId:
+                    manifest["baseinfo"] = model.record_to_json(vre.decode_baseinfo(ctx, buf))
+                elif recid == vre.RSCaseId:
+                    rscase, subcases = vre.decode_rscase(ctx, buf)
+                    manifest["rscases"].append({
+                        "rscase": model.record_to_json(rscase),
+                        "subcases": [{"subcase": model.record_to_json(subcase),
+                                      "modes": [model.record_to_json(mode) for mode in modes]}
+                                     for subcase, modes in subcases],
+                    })
+                elif recid == vre.DataPropId:
+                    dataprop = len(manifest["dataprops"])
+                    manifest["dataprops"].append(model.record_to_json(vre.decode_dataprop(ctx, buf)))
+                elif recid == vre.NodeValId:
+                    _write_datasets(store_dir, manifest, "node", dataprop,
+                                    vre.decode_nodeval(ctx, buf, as_array=True, types=types)[1])
+                elif recid == vre.ElemValId:
+                    _write_datasets(store_dir, manifest, "voxel", dataprop,
+                                    vre.decode_elemval(ctx, buf, as_array=True, types=types)[1])
+                buf = reader.next_record()
+    with open(os.path.join(store_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    return len(manifest["datasets"])
+
+
+def _write_datasets(store_dir, manifest, kind, dataprop, outputs):
+    # values are views of the .vre, they are not kept after this returns so the reader can unmap it
+    for output, values in outputs:
+        filename = dataset_filename(len(manifest["datasets"]))
+        values = values.astype(values.dtype.newbyteorder("="), copy=False)
+        with open(os.path.join(store_dir, filename), "wb") as fv:
+            values.tofile(fv)
+        manifest["datasets"].append({
+            "kind": kind,
+            "dataprop": dataprop,
+            "output": model.record_to_json(output),
+            "dtype": values.dtype.str,
+            "count": len(values),
+            "file": filename,
+        })
+
+
+class StoredDataset:
+    """
+    Dataset of the store, values is np.memmap of its file opened on first access
+    """
+
+    def __init__(self, output, filename, count, dtype):
+        self.output = output
+        self.filename = filename
+        self.count = count
+        self.dtype = dtype
+        self._values = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.count * self.dtype.itemsize
+
+    @property
+    def values(self):
+        if self._values is None:
+            if self.count == 0:
+                self._values = np.empty(0, dtype=self.dtype)
+            else:
+                self._values = np.memmap(self.filename, dtype=self.dtype, mode="r", shape=(self.count,))
+        return self._values
+
+    def __repr__(self):
+        return 'StoredDataset({}, {}, {})'.format(self.output.type, self.count, self.dtype)
+
+
+class ResultStore:
+    """
+    Reader of the store written by convert
+
+    node_datasets / voxel_datasets are {model.ResultKey: StoredDataset} in the order of the .vre
+    as model.ResultFile, only the pages of the values read are loaded.
+
+    store = ResultStore("result.store")
+    values = store.voxel_datasets[key].values
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != STORE_VERSION:
+            raise Exception("store version not match", manifest["version"], STORE_VERSION)
+        self.source = manifest["source"]
+        self.byteorder = manifest["header"]["byteorder"]
+        self.header = model.record_from_json(vre.Header, manifest["header"]["header"])
+        self.version = model.record_from_json(vre.Version, manifest["header"]["version"])
+        self.title = load_record(vre.Title, manifest["title"])
+        self.param = load_record(vre.Param, manifest["param"])
+        self.baseinfo = load_record(vre.Baseinfo, manifest["baseinfo"])
+        self.rscases = [(model.record_from_json(vre.RSCase, r["rscase"]),
+                         [(model.record_from_json(vre.RSSubCase, s["subcase"]),
+                           [model.record_from_json(vre.RSMode, m) for m in s["modes"]])
+                          for s in r["subcases"]])
+                        for r in manifest["rscases"]]
+        self.dataprops = [model.record_from_json(vre.DataProp, d) for d in manifest["dataprops"]]
+        self.node_datasets = {}
+        self.voxel_datasets = {}
+        for d in manifest["datasets"]:
+            output = model.record_from_json(vre.Output, d["output"])
+            if d["dataprop"] is None:
+                step = vre.Step(None, None, None, None, None)
+            else:
+                step = vre.dataprop_step(self.dataprops[d["dataprop"]])
+            datasets = self.node_datasets if d["kind"] == "node" else self.voxel_datasets
+            datasets[model.ResultKey(*step, output.type)] = StoredDataset(
+                output, os.path.join(store_dir, d["file"]), d["count"], np.dtype(d["dtype"]))
+
+    def is_stale(self):
+        """
+        True if the source .vre is changed or removed after the conversion
+        """
+        try:
+            st = os.stat(self.source["filename"])
+        except FileNotFoundError:
+            return True
+        return st.st_size != self.source["size"] or st.st_mtime_ns != self.source["mtime_ns"]
+
+    def steps(self):
+        return model.result_steps(self.node_datasets, self.voxel_datasets)
+
+    def types(self):
+        return model.result_types(self.node_datasets, self.voxel_datasets)
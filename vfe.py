@@ -1,11 +1,20 @@
+import mmap
+import os
 import struct
 from collections import namedtuple
 
+import numpy as np
+
 
 class DecodeError(Exception):
     pass
 
 
+# compiled struct.Struct shared by every Context of the same file layout
+# key : (byteorder, size_of_int, size_of_real) -> {format: struct.Struct}
+_codecs = {}
+
+
 class Context:
     def __init__(self, byteorder, size_of_int, size_of_real):
         self.bo = byteorder
@@ -19,10 +28,15 @@ class Context:
             raise DecodeError("size_of_int must be 4 or 8", size_of_int)
         if size_of_real == 4:
             self.r = "f"
-        elif size_of_int == 8:
+        elif size_of_real == 8:
             self.r = "d"
         else:
             raise DecodeError("size_of_real must be 4 or 8", size_of_real)
+        key = (byteorder, size_of_int, size_of_real)
+        self.codecs = _codecs.get(key)
+        if self.codecs is None:
+            self.codecs = _codecs[key] = {}
+            self.precompile()
 
     def next_record(self, f):
         size_decoder = self.create("i")
@@ -45,47 +59,177 @@ class Context:
         return buflen + buf + buflen
 
     def create(self, fmt):
+        try:
+            return self.codecs[fmt]
+        except KeyError:
+            codec = self.codecs[fmt] = self.compile(fmt)
+            return codec
+
+    def precompile(self):
+        # compile every *Format constant of this module once per file layout
+        self.create("i")
+        for name, fmt in list(globals().items()):
+            if name.endswith("Format") and name != "HeaderFormat":
+                self.create(fmt)
+
+    def compile(self, fmt):
         fmt = fmt.replace("i", self.i)
         fmt = fmt.replace("f", self.r)
         fmt = fmt.replace("I", 'i')
         return struct.Struct(self.bo + fmt)
 
+    def dtype(self, fmt, fields):
+        # numpy structured dtype of a format made of single i / f / I fields, mapped like create
+        codes = {"i": "i" + str(self.size_of_int), "f": "f" + str(self.size_of_real), "I": "i4"}
+        return np.dtype([(name, self.bo + codes[c]) for name, c in zip(fields, fmt)])
+
+
+class RecordReader:
+    """
+    Record reader over the memory-mapped file
 
-def decode_list(ctx, buf, formats):
+    next_record returns the record body (without the length prefix and
+    trailer) as memoryview sliced from the mapping, so no bytes are copied.
+    every decode_* function accepts the returned view as is.
+    """
+
+    def __init__(self, ctx, f):
+        self.ctx = ctx
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self._mmap)
+        # the header is already consumed by decode_header
+        self.pos = f.tell()
+        # file offset of the last record returned by next_record
+        self.offset = None
+
+    def next_record(self):
+        if self.pos >= len(self.buf):
+            return None
+        size_decoder = self.ctx.create("i")
+        start = self.pos + size_decoder.size
+        if start > len(self.buf):
+            raise DecodeError("record is truncated", self.pos)
+        l, = size_decoder.unpack_from(self.buf, self.pos)
+        end = start + l
+        if end + size_decoder.size > len(self.buf):
+            raise DecodeError("record is truncated", self.pos)
+        ll, = size_decoder.unpack_from(self.buf, end)
+        if l != ll:
+            raise DecodeError("record length not match", l, ll)
+        self.offset = self.pos
+        self.pos = end + size_decoder.size
+        return self.buf[start:end]
+
+    def close(self):
+        """
+        unmap the file, the views returned by next_record must be released before
+
+        a view still held (or an array decoded over it) keeps the file mapped until it is released.
+        """
+        self.buf.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a view is still held by the caller, the mapping is unmapped when the last one is released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RecordWriter:
+    """
+    Record writer to the file
+
+    each record is encoded straight into one bytearray behind a reserved
+    length prefix, the prefix is back-patched once the body is encoded.
+    every encode_* function accepts the out argument used for this.
+    """
+
+    def __init__(self, ctx, f):
+        self.ctx = ctx
+        self.f = f
+        self.buf = bytearray()
+
+    def write_header(self, header, version):
+        self.f.write(encode_header(self.ctx, header, version))
+
+    def write_record(self, encoder, value):
+        size_encoder = self.ctx.create("i")
+        buf = self.buf
+        try:
+            # reserve the length prefix
+            buf += bytes(size_encoder.size)
+            encoder(self.ctx, value, out=buf)
+            l = len(buf) - size_encoder.size
+            size_encoder.pack_into(buf, 0, l)
+            buf += size_encoder.pack(l)
+            self.f.write(buf)
+        finally:
+            del buf[:]
+
+    def write_body(self, body):
+        # record body already encoded, e.g. copied from another file
+        size_encoder = self.ctx.create("i")
+        buflen = size_encoder.pack(len(body))
+        self.f.write(buflen)
+        self.f.write(body)
+        self.f.write(buflen)
+
+
+def decode_list(ctx, buf, formats, offset=0):
+    """
+    decode the list starting at offset of buf, returns the decoded length and the list
+
+    nested lists are decoded at their offset in the same buf, buf is never sliced.
+    """
     size_decoder = ctx.create("i")
-    n, = size_decoder.unpack_from(buf, 0)
+    n, = size_decoder.unpack_from(buf, offset)
     fmt, model = formats[0]
 
-    i = size_decoder.size
+    i = offset + size_decoder.size
     dec = ctx.create(fmt)
     formats = formats[1:]
+    if len(formats) == 0:
+        # flat list is unpacked in one pass over the view of its bytes
+        end = i + n * dec.size
+        if end > len(buf):
+            raise DecodeError("list is truncated", n)
+        models = list(map(model._make, dec.iter_unpack(memoryview(buf)[i:end])))
+        return (end - offset, models)
     models = []
     for _ in range(n):
         m = model._make(dec.unpack_from(buf, i))
         i += dec.size
-        if len(formats) > 0:
-            ii, ms2 = decode_list(ctx, buf[i:], formats)
-            i += ii
-            m = (m, ms2)
-        models.append(m)
-    return (i, models)
-
-
-def encode_list(ctx, formats, values):
+        ii, ms2 = decode_list(ctx, buf, formats, i)
+        i += ii
+        models.append((m, ms2))
+    return (i - offset, models)
+
+
+def encode_list(ctx, formats, values, out=None):
+    """
+    append the encoded list to out (new bytearray if None) and return out
+    """
+    if out is None:
+        out = bytearray()
     size_encoder = ctx.create("i")
     fmt = formats[0]
     formats = formats[1:]
     encoder = ctx.create(fmt)
 
-    buf = size_encoder.pack(len(values))
+    out += size_encoder.pack(len(values))
     for v in values:
         if len(formats) == 0:
-            buf += encoder.pack(*v)
+            out += encoder.pack(*v)
         else:
             v2, vals2 = v
-            buf += encoder.pack(*v2)
-            buf += encode_list(ctx, formats, vals2)
-    return buf
+            out += encoder.pack(*v2)
+            encode_list(ctx, formats, vals2, out)
+    return out
 
 
 def decode_recid(ctx, buf):
@@ -175,8 +319,9 @@ def encode_header(ctx, header, version):
         byteorder = 0
     else:
         byteorder = 1
-    bufheader = struct.pack(ctx.bo + 'b' + HeaderFormat, byteorder, ctx.size_of_int, ctx.size_of_real, header.is_p,
-                            header.prog, header.version, header.revision)
+    bufheader = struct.pack(ctx.bo + 'b' + HeaderFormat, byteorder, ctx.size_of_int, ctx.size_of_real, header.is_s,
+                            header.is_p, header.prog, header.kind_section, header.loc_section, header.version,
+                            header.revision)
     bufreclen = struct.pack(ctx.bo + 'i', len(bufheader))
     bufversion = struct.pack(ctx.bo + VersionFormat, *version)
     bufverlen = struct.pack(ctx.bo + 'i', len(bufversion))
@@ -218,8 +363,11 @@ def decode_title(ctx, buf):
     return Title._make(title_decoder.unpack(buf))
 
 
-def encode_title(ctx, title):
-    return ctx.create(TitleFormat).pack(*title)
+def encode_title(ctx, title, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(TitleFormat).pack(*title)
+    return out
 
 
 #
@@ -310,8 +458,11 @@ def decode_param(ctx, buf):
     return Param._make(param_decoder.unpack(buf))
 
 
-def encode_param(ctx, param):
-    return ctx.create(ParamFormat).pack(*param)
+def encode_param(ctx, param, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ParamFormat).pack(*param)
+    return out
 
 
 #
@@ -351,17 +502,19 @@ SSubcase = namedtuple('SSubcase', [
 def decode_subcase(ctx, buf):
     subcase_decoder = ctx.create(SubcaseFormat)
     subcase = Subcase._make(subcase_decoder.unpack_from(buf, 0))
-    n, ssubcases = decode_list(ctx, buf[subcase_decoder.size:], [
+    n, ssubcases = decode_list(ctx, buf, [
         (SSubcaseFormat, SSubcase),
-    ])
+    ], subcase_decoder.size)
     if len(buf) - subcase_decoder.size - n > 0:
         raise DecodeError("subcase is too long")
     return (subcase, ssubcases)
 
 
-def encode_subcase(ctx, subcase):
-    return ctx.create(SubcaseFormat).pack(*subcase[0]) \
-           + encode_list(ctx, [SSubcaseFormat], subcase[1])
+def encode_subcase(ctx, subcase, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(SubcaseFormat).pack(*subcase[0])
+    return encode_list(ctx, [SSubcaseFormat], subcase[1], out)
 
 
 #
@@ -416,8 +569,11 @@ def decode_modelprp(ctx, buf):
     return ModelPrp._make(modelprp_decoder.unpack(buf))
 
 
-def encode_modelprp(ctx, modelprp):
-    return ctx.create(ModelPrpFormat).pack(*modelprp)
+def encode_modelprp(ctx, modelprp, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ModelPrpFormat).pack(*modelprp)
+    return out
 
 
 #
@@ -473,20 +629,41 @@ Voxcel = namedtuple('Voxcel', [
 ])
 
 
-def decode_element(ctx, buf):
+def decode_element(ctx, buf, as_array=False):
+    """
+    voxcels are list of Voxcel, or with as_array one numpy structured array
+    with the fields of Voxcel in the byteorder of the file sharing memory with buf.
+    voxcels['pos_x'] etc. are the column arrays.
+    """
     element_decoder = ctx.create(ElementFormat)
     element = Element._make(element_decoder.unpack_from(buf, 0))
-    n, voxcels = decode_list(ctx, buf[element_decoder.size:], [
-        (VoxcelFormat, Voxcel),
-    ])
+    if as_array:
+        size_decoder = ctx.create("i")
+        size, = size_decoder.unpack_from(buf, element_decoder.size)
+        voxcels = np.frombuffer(buf, dtype=ctx.dtype(VoxcelFormat, Voxcel._fields), count=size,
+                                offset=element_decoder.size + size_decoder.size)
+        n = size_decoder.size + voxcels.nbytes
+    else:
+        n, voxcels = decode_list(ctx, buf, [
+            (VoxcelFormat, Voxcel),
+        ], element_decoder.size)
     if len(buf) - element_decoder.size - n > 0:
         raise DecodeError("element is too long")
     return (element, voxcels)
 
 
-def encode_element(ctx, element):
-    return ctx.create(ElementFormat).pack(*element[0]) \
-           + encode_list(ctx, [VoxcelFormat], element[1])
+def encode_element(ctx, element, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ElementFormat).pack(*element[0])
+    voxcels = element[1]
+    if isinstance(voxcels, np.ndarray):
+        out += ctx.create("i").pack(len(voxcels))
+        voxcels = np.ascontiguousarray(voxcels, dtype=ctx.dtype(VoxcelFormat, Voxcel._fields))
+        # append the array memory as is, without an intermediate bytes
+        out += memoryview(voxcels).cast("B")
+        return out
+    return encode_list(ctx, [VoxcelFormat], voxcels, out)
 
 
 #
@@ -530,38 +707,46 @@ def decode_constset(ctx, buf):
     constset_decoder = ctx.create(ConstSetFormat)
     constset = ConstSet._make(constset_decoder.unpack_from(buf, 0))
     size_decoder = ctx.create("i")
-    size, = size_decoder.unpack_from(buf[constset_decoder.size:], 0)
+    size, = size_decoder.unpack_from(buf, constset_decoder.size)
     n = constset_decoder.size + size_decoder.size
     consts = []
     for i in range(size):
-        nn, const = decode_const(ctx, buf[n:])
+        nn, const = decode_const(ctx, buf, n)
         n += nn
         consts.append(const)
-    if len(buf) - constset_decoder.size - n > 0:
+    if len(buf) - n > 0:
         raise DecodeError("constset is too long")
     return (constset, consts)
 
 
-def decode_const(ctx, buf):
+def decode_const(ctx, buf, offset=0):
     const_decoder = ctx.create(ConstFormat)
-    const = Const._make(const_decoder.unpack_from(buf, 0))
-    n, node_consts = decode_list(ctx, buf[const_decoder.size:], [
+    const = Const._make(const_decoder.unpack_from(buf, offset))
+    n, node_consts = decode_list(ctx, buf, [
         (ConstSetNodeFormat, ConstSetNode),
-    ])
-    nn, temp_consts = decode_list(ctx, buf[const_decoder.size + n:], [
+    ], offset + const_decoder.size)
+    nn, temp_consts = decode_list(ctx, buf, [
         (ConstSetTempFormat, ConstSetTemp),
-    ])
+    ], offset + const_decoder.size + n)
     return const_decoder.size + n + nn, (const, node_consts, temp_consts)
 
 
-def encode_const(ctx, const):
-    return ctx.create(ConstFormat).pack(*const[0]) \
-           + encode_list(ctx, [ConstSetNodeFormat], const[1]) \
-           + encode_list(ctx, [ConstSetTempFormat], const[2])
+def encode_const(ctx, const, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ConstFormat).pack(*const[0])
+    encode_list(ctx, [ConstSetNodeFormat], const[1], out)
+    return encode_list(ctx, [ConstSetTempFormat], const[2], out)
 
 
-def encode_constset(ctx, constset):
-    return ctx.create(ConstSetFormat).pack(*constset[0]) + b''.join([encode_const(ctx, c) for c in constset[1]])
+def encode_constset(ctx, constset, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ConstSetFormat).pack(*constset[0])
+    out += ctx.create("i").pack(len(constset[1]))
+    for c in constset[1]:
+        encode_const(ctx, c, out)
+    return out
 
 
 #
@@ -639,18 +824,94 @@ ConstNodeNode = namedtuple('ConstNodeNode', [
 def decode_constnode(ctx, buf):
     constnode_decoder = ctx.create(ConstNodeFormat)
     constnode = ConstNode._make(constnode_decoder.unpack_from(buf, 0))
-    n, constnodedefs = decode_list(ctx, buf[constnode_decoder.size:], [
+    n, constnodedefs = decode_list(ctx, buf, [
         (ConstNodeDefFormat, ConstNodeDef),
         (ConstNodeNodeFormat, ConstNodeNode),
-    ])
+    ], constnode_decoder.size)
     if len(buf) - constnode_decoder.size - n > 0:
         raise DecodeError("constnode is too long")
     return (constnode, constnodedefs)
 
 
-def encode_constnode(ctx, constnode):
-    return ctx.create(ConstNodeFormat).pack(*constnode[0]) \
-           + encode_list(ctx, [ConstNodeFormat, ConstNodeNodeFormat], constnode[1])
+def encode_constnode(ctx, constnode, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ConstNodeFormat).pack(*constnode[0])
+    return encode_list(ctx, [ConstNodeDefFormat, ConstNodeNodeFormat], constnode[1], out)
+
+
+# ================================
+# レコード走査
+# ================================
+
+# decoder of each record id, used by Record.decode
+Decoders = {
+    TitleId: decode_title,
+    ParamId: decode_param,
+    SubcaseId: decode_subcase,
+    ModelPrpId: decode_modelprp,
+    ElementId: decode_element,
+    ConstSetId: decode_constset,
+    ConstNodeId: decode_constnode,
+}
+
+
+class Record:
+    """
+    Record found by iter_records
+
+    read returns the body as memoryview of the memory-mapped file, read / decode copy nothing.
+    the view is sliced on read only, so a record does not keep the file mapped by itself,
+    and it can be read only while iter_records is iterating.
+    offset and length are those of the body without the length prefix and trailer.
+    """
+
+    def __init__(self, ctx, buf, recid, offset, length):
+        self.ctx = ctx
+        self.buf = buf
+        self.recid = recid
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        return self.buf[self.offset:self.offset + self.length]
+
+    def decode(self, **kwargs):
+        decoder = Decoders.get(self.recid)
+        if decoder is None:
+            raise DecodeError("unknown recid", self.recid)
+        return decoder(self.ctx, self.read(), **kwargs)
+
+    def __repr__(self):
+        return 'Record({}, {}, {})'.format(self.recid, self.offset, self.length)
+
+
+def iter_records(path_or_file, recids=None):
+    """
+    yield Record of every record, or only of recids
+
+    the file is memory-mapped, only the pages of the records read are loaded.
+    the file is opened and closed here when the path is given.
+    """
+    if isinstance(path_or_file, (str, bytes, os.PathLike)):
+        with open(path_or_file, "rb") as f:
+            yield from iter_records(f, recids)
+        return
+    f = path_or_file
+    f.seek(0)
+    byteorder, header, version = decode_header(f)
+    ctx = Context(byteorder, header.size_of_int, header.size_of_real)
+    size = ctx.create("i").size
+    with RecordReader(ctx, f) as reader:
+        buf = reader.next_record()
+        while buf is not None:
+            recid = decode_recid(ctx, buf)
+            length = len(buf)
+            # Record.read slices the body again, no view is held here while the caller runs
+            buf.release()
+            if recids is None or recid in recids:
+                yield Record(ctx, reader.buf, recid, reader.offset + size, length)
+            buf = reader.next_record()
 
 
 if __name__ == '__main__':
@@ -662,17 +923,16 @@ if __name__ == '__main__':
     print('header', header)
     print('version', version)
 
-    buf = ctx.next_record(f)
-    while buf is not None:
-        recid = decode_recid(ctx, ctx.unwrap_record(buf))
+    for record in iter_records(f):
+        recid = record.recid
         if recid == TitleId:
-            title = decode_title(ctx, ctx.unwrap_record(buf))
+            title = record.decode()
             print('title', title)
         elif recid == ParamId:
-            param = decode_param(ctx, ctx.unwrap_record(buf))
+            param = record.decode()
             print('param', param)
         elif recid == SubcaseId:
-            subcase = decode_subcase(ctx, ctx.unwrap_record(buf))
+            subcase = record.decode()
             # print('subcase', subcase)
             print('succase count', len(subcase[1]))
         elif recid == 22:
@@ -686,12 +946,12 @@ if __name__ == '__main__':
         elif recid == 26:
             print("skip FUNCTION")
         elif recid == ModelPrpId:
-            modelprp = decode_modelprp(ctx, ctx.unwrap_record(buf))
+            modelprp = record.decode()
             print('modelprp', modelprp)
         elif recid == 102:
             print("skip PROP")
         elif recid == ElementId:
-            element = decode_element(ctx, ctx.unwrap_record(buf))
+            element = record.decode()
             # print('element', element)
             print("element count", len(element[1]))
         elif recid == 121:
@@ -701,10 +961,10 @@ if __name__ == '__main__':
         elif recid == 123:
             print("skip SPRING")
         elif recid == ConstSetId:
-            constset = decode_constset(ctx, ctx.unwrap_record(buf))
+            constset = record.decode()
             print('constset', constset)
         elif recid == ConstNodeId:
-            constnode = decode_constnode(ctx, ctx.unwrap_record(buf))
+            constnode = record.decode()
             (_constnode, constnodedefs) = constnode
             print('constnode', _constnode)
             print('len constnodedefs', len(constnodedefs))
@@ -778,7 +1038,6 @@ if __name__ == '__main__':
             print("skip S_FACE_VOXEL")
         else:
             print("unknown recid :", recid)
-        buf = ctx.next_record(f)
 
     f.close()
     print('decode done')
@@ -1,11 +1,22 @@
+import errno
+import io
+import mmap
+import os
 import struct
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+
+import numpy as np
 
 
 class DecodeError(Exception):
     pass
 
 
+# compiled struct.Struct shared by every Context of the same file layout
+# key : (byteorder, size_of_int, size_of_real) -> {format: struct.Struct}
+_codecs = {}
+
+
 class Context:
     def __init__(self, byteorder, size_of_int, size_of_real):
         self.bo = byteorder
@@ -19,10 +30,15 @@ class Context:
             raise DecodeError("size_of_int must be 4 or 8", size_of_int)
         if size_of_real == 4:
             self.r = "f"
-        elif size_of_int == 8:
+        elif size_of_real == 8:
             self.r = "d"
         else:
             raise DecodeError("size_of_real must be 4 or 8", size_of_real)
+        key = (byteorder, size_of_int, size_of_real)
+        self.codecs = _codecs.get(key)
+        if self.codecs is None:
+            self.codecs = _codecs[key] = {}
+            self.precompile()
 
     def next_record(self, f):
         size_decoder = self.create("i")
@@ -45,46 +61,172 @@ class Context:
         return buflen + buf + buflen
 
     def create(self, fmt):
+        try:
+            return self.codecs[fmt]
+        except KeyError:
+            codec = self.codecs[fmt] = self.compile(fmt)
+            return codec
+
+    def precompile(self):
+        # compile every *Format constant of this module once per file layout
+        # formats with their own byteorder (sidecar files) are not record formats
+        self.create("i")
+        for name, fmt in list(globals().items()):
+            if name.endswith("Format") and name != "HeaderFormat" and fmt[0] not in "<>=!@":
+                self.create(fmt)
+
+    def compile(self, fmt):
         fmt = fmt.replace("i", self.i)
         fmt = fmt.replace("f", self.r)
         return struct.Struct(self.bo + fmt)
 
 
-def decode_list(ctx, buf, formats):
+class RecordReader:
+    """
+    Record reader over the memory-mapped file
+
+    next_record returns the record body (without the length prefix and
+    trailer) as memoryview sliced from the mapping, so no bytes are copied.
+    every decode_* function accepts the returned view as is.
+    """
+
+    def __init__(self, ctx, f):
+        self.ctx = ctx
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self._mmap)
+        # the header is already consumed by decode_header
+        self.pos = f.tell()
+        # file offset of the last record returned by next_record
+        self.offset = None
+
+    def next_record(self):
+        if self.pos >= len(self.buf):
+            return None
+        size_decoder = self.ctx.create("i")
+        start = self.pos + size_decoder.size
+        if start > len(self.buf):
+            raise DecodeError("record is truncated", self.pos)
+        l, = size_decoder.unpack_from(self.buf, self.pos)
+        end = start + l
+        if end + size_decoder.size > len(self.buf):
+            raise DecodeError("record is truncated", self.pos)
+        ll, = size_decoder.unpack_from(self.buf, end)
+        if l != ll:
+            raise DecodeError("record length not match", l, ll)
+        self.offset = self.pos
+        self.pos = end + size_decoder.size
+        return self.buf[start:end]
+
+    def close(self):
+        """
+        unmap the file, the views returned by next_record must be released before
+
+        a view still held (or an array decoded over it) keeps the file mapped until it is released.
+        """
+        self.buf.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a view is still held by the caller, the mapping is unmapped when the last one is released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RecordWriter:
+    """
+    Record writer to the file
+
+    each record is encoded straight into one bytearray behind a reserved
+    length prefix, the prefix is back-patched once the body is encoded.
+    every encode_* function accepts the out argument used for this.
+    """
+
+    def __init__(self, ctx, f):
+        self.ctx = ctx
+        self.f = f
+        self.buf = bytearray()
+
+    def write_header(self, header, version):
+        self.f.write(encode_header(self.ctx, header, version))
+
+    def write_record(self, encoder, value):
+        size_encoder = self.ctx.create("i")
+        buf = self.buf
+        try:
+            # reserve the length prefix
+            buf += bytes(size_encoder.size)
+            encoder(self.ctx, value, out=buf)
+            l = len(buf) - size_encoder.size
+            size_encoder.pack_into(buf, 0, l)
+            buf += size_encoder.pack(l)
+            self.f.write(buf)
+        finally:
+            del buf[:]
+
+    def write_body(self, body):
+        # record body already encoded, e.g. copied from another file
+        size_encoder = self.ctx.create("i")
+        buflen = size_encoder.pack(len(body))
+        self.f.write(buflen)
+        self.f.write(body)
+        self.f.write(buflen)
+
+
+def decode_list(ctx, buf, formats, offset=0):
+    """
+    decode the list starting at offset of buf, returns the decoded length and the list
+
+    nested lists are decoded at their offset in the same buf, buf is never sliced.
+    """
     size_decoder = ctx.create("i")
-    n, = size_decoder.unpack_from(buf, 0)
+    n, = size_decoder.unpack_from(buf, offset)
     fmt, model = formats[0]
 
-    i = size_decoder.size
+    i = offset + size_decoder.size
     dec = ctx.create(fmt)
     formats = formats[1:]
+    if len(formats) == 0:
+        # flat list is unpacked in one pass over the view of its bytes
+        end = i + n * dec.size
+        if end > len(buf):
+            raise DecodeError("list is truncated", n)
+        models = list(map(model._make, dec.iter_unpack(memoryview(buf)[i:end])))
+        return (end - offset, models)
     models = []
     for _ in range(n):
         m = model._make(dec.unpack_from(buf, i))
         i += dec.size
-        if len(formats) > 0:
-            ii, ms2 = decode_list(ctx, buf[i:], formats)
-            i += ii
-            m = (m, ms2)
-        models.append(m)
-    return (i, models)
-
-
-def encode_list(ctx, formats, values):
+        ii, ms2 = decode_list(ctx, buf, formats, i)
+        i += ii
+        models.append((m, ms2))
+    return (i - offset, models)
+
+
+def encode_list(ctx, formats, values, out=None):
+    """
+    append the encoded list to out (new bytearray if None) and return out
+    """
+    if out is None:
+        out = bytearray()
     size_encoder = ctx.create("i")
     fmt = formats[0]
     formats = formats[1:]
     encoder = ctx.create(fmt)
 
-    buf = size_encoder.pack(len(values))
+    out += size_encoder.pack(len(values))
     for v in values:
         if len(formats) == 0:
-            buf += encoder.pack(*v)
+            out += encoder.pack(*v)
         else:
             v2, vals2 = v
-            buf += encoder.pack(*v2)
-            buf += encode_list(ctx, formats, vals2)
-    return buf
+            out += encoder.pack(*v2)
+            encode_list(ctx, formats, vals2, out)
+    return out
 
 
 def decode_recid(ctx, buf):
@@ -208,8 +350,11 @@ def decode_title(ctx, buf):
     return Title._make(title_decoder.unpack(buf))
 
 
-def encode_title(ctx, title):
-    return ctx.create(TitleFormat).pack(*title)
+def encode_title(ctx, title, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(TitleFormat).pack(*title)
+    return out
 
 
 #
@@ -297,8 +442,11 @@ def decode_param(ctx, buf):
     return Param._make(param_decoder.unpack(buf))
 
 
-def encode_param(ctx, param):
-    return ctx.create(ParamFormat).pack(*param)
+def encode_param(ctx, param, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ParamFormat).pack(*param)
+    return out
 
 
 #
@@ -326,8 +474,11 @@ def decode_baseinfo(ctx, buf):
     return Baseinfo._make(baseinfo_decoder.unpack(buf))
 
 
-def encode_baseinfo(ctx, baseinfo):
-    return ctx.create(BaseinfoFormat).pack(*baseinfo)
+def encode_baseinfo(ctx, baseinfo, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(BaseinfoFormat).pack(*baseinfo)
+    return out
 
 
 #
@@ -375,18 +526,20 @@ RSMode = namedtuple('RSMode', [
 def decode_rscase(ctx, buf):
     rscase_decoder = ctx.create(RSCaseFormat)
     rscase = RSCase._make(rscase_decoder.unpack_from(buf, 0))
-    n, rssubcases = decode_list(ctx, buf[rscase_decoder.size:], [
+    n, rssubcases = decode_list(ctx, buf, [
         (RSSubCaseFormat, RSSubCase),
         (RSModeFormat, RSMode),
-    ])
+    ], rscase_decoder.size)
     if len(buf) - rscase_decoder.size - n > 0:
         raise DecodeError("rscase is too long")
     return (rscase, rssubcases)
 
 
-def encode_rscase(ctx, rscase):
-    return ctx.create(RSCaseFormat).pack(*rscase[0]) \
-           + encode_list(ctx, [RSSubCaseFormat, RSModeFormat], rscase[1])
+def encode_rscase(ctx, rscase, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(RSCaseFormat).pack(*rscase[0])
+    return encode_list(ctx, [RSSubCaseFormat, RSModeFormat], rscase[1], out)
 
 
 #
@@ -440,23 +593,25 @@ def decode_modelinf(ctx, buf):
     modelinf_decoder = ctx.create(ModelinfFormat)
     modelinf = Modelinf._make(modelinf_decoder.unpack_from(buf, 0))
     i = modelinf_decoder.size
-    j, voxcel_models = decode_list(ctx, buf[i:], [
+    j, voxcel_models = decode_list(ctx, buf, [
         (VoxcelModelFormat, VoxcelModel),
-    ])
+    ], i)
     i += j
-    j, stl_models = decode_list(ctx, buf[i:], [
+    j, stl_models = decode_list(ctx, buf, [
         (STLModelFormat, STLModel),
-    ])
+    ], i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("modelinf is too long")
     return (modelinf, voxcel_models, stl_models)
 
 
-def encode_modelinf(ctx, modelinf):
-    return ctx.create(ModelinfFormat).pack(*modelinf[0]) \
-           + encode_list(ctx, [VoxcelModelFormat], modelinf[1]) \
-           + encode_list(ctx, [STLModelFormat], modelinf[2])
+def encode_modelinf(ctx, modelinf, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ModelinfFormat).pack(*modelinf[0])
+    encode_list(ctx, [VoxcelModelFormat], modelinf[1], out)
+    return encode_list(ctx, [STLModelFormat], modelinf[2], out)
 
 
 #
@@ -534,19 +689,21 @@ def decode_simple_result(ctx, buf):
     simple_result_decoder = ctx.create(SimpleResultFormat)
     simple_result = SimpleResult._make(simple_result_decoder.unpack_from(buf, 0))
     i = simple_result_decoder.size
-    j, voxcel_models = decode_list(ctx, buf[i:], [
+    j, voxcel_models = decode_list(ctx, buf, [
         (SimpleVoxcelModelFormat, SimpleVoxcelModel),
         (DetailAreaFormat, DetailArea),
-    ])
+    ], i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("simple_result is too long")
     return (simple_result, voxcel_models)
 
 
-def encode_simple_result(ctx, simple_result):
-    return ctx.create(SimpleResultFormat).pack(*simple_result[0]) \
-           + encode_list(ctx, [SimpleVoxcelModelFormat, DetailAreaFormat], simple_result[1])
+def encode_simple_result(ctx, simple_result, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(SimpleResultFormat).pack(*simple_result[0])
+    return encode_list(ctx, [SimpleVoxcelModelFormat, DetailAreaFormat], simple_result[1], out)
 
 
 # ================================
@@ -590,8 +747,11 @@ def decode_dataprop(ctx, buf):
     return DataProp._make(dataprop_decoder.unpack(buf))
 
 
-def encode_dataprop(ctx, dataprop):
-    return ctx.create(DataPropFormat).pack(*dataprop)
+def encode_dataprop(ctx, dataprop, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(DataPropFormat).pack(*dataprop)
+    return out
 
 
 #
@@ -618,42 +778,165 @@ OutputValue = namedtuple('OutputValue', [
 ])
 
 
-def decode_outputs(ctx, buf):
+def output_dtype(ctx, output):
+    if output.size_of_real not in (4, 8):
+        raise DecodeError("size_of_real must be 4 or 8", output.size_of_real)
+    return np.dtype(ctx.bo + "f" + str(output.size_of_real))
+
+
+def to_native(values):
+    """
+    copy of the values in native byteorder, no longer sharing memory with the record
+    """
+    return values.astype(values.dtype.newbyteorder("="))
+
+
+def as_native(values):
+    """
+    values itself when native and aligned, otherwise to_native copy of them
+    """
+    if values.dtype.isnative and values.flags.aligned:
+        return values
+    return to_native(values)
+
+
+class Dataset:
+    """
+    Values of one dataset decoded on access
+
+    holds the Output header and the position of the values in the record.
+    values is a zero-copy view of the record when the byteorder of the file
+    is native, otherwise a native copy. with cache (DatasetCache) decoded
+    values stay resident until evicted.
+    """
+
+    def __init__(self, output, buf, offset, count, dtype):
+        self.output = output
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.dtype = dtype
+        self.cache = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.count * self.dtype.itemsize
+
+    def decode(self):
+        return as_native(np.frombuffer(self.buf, dtype=self.dtype, count=self.count, offset=self.offset))
+
+    @property
+    def values(self):
+        if self.cache is None:
+            return self.decode()
+        return self.cache.get(self)
+
+    def __repr__(self):
+        return 'Dataset({}, {})'.format(self.output.type, self.count)
+
+
+class DatasetCache:
+    """
+    Keep decoded values of the last maxsize datasets accessed
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+
+    def get(self, dataset):
+        values = self._values.get(dataset)
+        if values is not None:
+            self._values.move_to_end(dataset)
+            return values
+        values = dataset.decode()
+        if self.maxsize > 0:
+            self._values[dataset] = values
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+        return values
+
+    def __len__(self):
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
+
+
+def decode_outputs(ctx, buf, as_array=False, types=None, lazy=False, offset=0):
+    """
+    values of each dataset are list of OutputValue, or with as_array
+    one numpy array in the byteorder of the file sharing memory with buf,
+    or with lazy Dataset decoding the values on access
+
+    with types only datasets of the types are returned, the values of
+    the others are skipped by their count without being read.
+    returns the decoded length from offset and the datasets.
+    """
     size_decoder = ctx.create("i")
     output_decoder = ctx.create(OutputFormat)
 
-    n, = size_decoder.unpack_from(buf, 0)
-    i = size_decoder.size
+    n, = size_decoder.unpack_from(buf, offset)
+    i = offset + size_decoder.size
 
     outputs = []
     for _ in range(n):
         output = Output._make(output_decoder.unpack_from(buf, i))
         i += output_decoder.size
 
-        # create new context for size_of_read
-        j, values = decode_list(Context(ctx.bo, ctx.size_of_int, output.size_of_real), buf[i:], [
-            (OutputValueFormat, OutputValue),
-        ])
-        i += j
+        if types is not None and output.type not in types:
+            count, = size_decoder.unpack_from(buf, i)
+            i += size_decoder.size + count * output.size_of_real
+            continue
+        if lazy:
+            count, = size_decoder.unpack_from(buf, i)
+            i += size_decoder.size
+            values = Dataset(output, buf, i, count, output_dtype(ctx, output))
+            i += values.nbytes
+        elif as_array:
+            count, = size_decoder.unpack_from(buf, i)
+            i += size_decoder.size
+            values = np.frombuffer(buf, dtype=output_dtype(ctx, output), count=count, offset=i)
+            i += values.nbytes
+        else:
+            # create new context for size_of_read
+            j, values = decode_list(Context(ctx.bo, ctx.size_of_int, output.size_of_real), buf, [
+                (OutputValueFormat, OutputValue),
+            ], i)
+            i += j
         outputs.append((output, values))
-    return (i, outputs)
+    if i > len(buf):
+        raise DecodeError("outputs are truncated")
+    return (i - offset, outputs)
 
 
-def encode_outputs(ctx, outputs):
+def encode_outputs(ctx, outputs, out=None):
+    if out is None:
+        out = bytearray()
     size_encoder = ctx.create("i")
     output_encoder = ctx.create(OutputFormat)
-    buf = size_encoder.pack(len(outputs))
+    out += size_encoder.pack(len(outputs))
     for o in outputs:
         output, values = o
-        buf += output_encoder.pack(*output)
+        out += output_encoder.pack(*output)
         # optimize encode output values because it have too many values
         # buf += encode_list(Context(ctx.bo, ctx.size_of_int, output.size_of_real), [OutputValueFormat], values)
         ctx_v = Context(ctx.bo, ctx.size_of_int, output.size_of_real)
         size_v_encoder = ctx_v.create("i")
-        values_encoder = ctx_v.create(OutputValueFormat * len(values))
-        buf += size_v_encoder.pack(len(values))
-        buf += values_encoder.pack(*[v.value for v in values])
-    return buf
+        if isinstance(values, np.ndarray):
+            out += size_v_encoder.pack(len(values))
+            values = np.ascontiguousarray(values, dtype=output_dtype(ctx, output))
+            # append the array memory as is, without an intermediate bytes
+            out += memoryview(values).cast("B")
+            continue
+        # per-length format is not worth keeping in the shared registry
+        values_encoder = ctx_v.compile(str(len(values)) + OutputValueFormat)
+        out += size_v_encoder.pack(len(values))
+        out += values_encoder.pack(*[v.value for v in values])
+    return out
 
 
 #
@@ -672,20 +955,22 @@ NodeVal = namedtuple('NodeVal', [
 ])
 
 
-def decode_nodeval(ctx, buf):
+def decode_nodeval(ctx, buf, as_array=False, types=None, lazy=False):
     nodeval_decoder = ctx.create(NodeValFormat)
     nodeval = NodeVal._make(nodeval_decoder.unpack_from(buf, 0))
     i = nodeval_decoder.size
-    j, outputs = decode_outputs(ctx, buf[i:])
+    j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("nodeval is too long")
     return (nodeval, outputs)
 
 
-def encode_nodeval(ctx, nodeval):
-    return ctx.create(NodeValFormat).pack(*nodeval[0]) \
-           + encode_outputs(ctx, nodeval[1])
+def encode_nodeval(ctx, nodeval, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(NodeValFormat).pack(*nodeval[0])
+    return encode_outputs(ctx, nodeval[1], out)
 
 
 #
@@ -704,20 +989,22 @@ ElemVal = namedtuple('ElemVal', [
 ])
 
 
-def decode_elemval(ctx, buf):
+def decode_elemval(ctx, buf, as_array=False, types=None, lazy=False):
     elemval_decoder = ctx.create(ElemValFormat)
     elemval = ElemVal._make(elemval_decoder.unpack_from(buf, 0))
     i = elemval_decoder.size
-    j, outputs = decode_outputs(ctx, buf[i:])
+    j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("elemval is too long")
     return (elemval, outputs)
 
 
-def encode_elemval(ctx, elemval):
-    return ctx.create(ElemValFormat).pack(*elemval[0]) \
-           + encode_outputs(ctx, elemval[1])
+def encode_elemval(ctx, elemval, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ElemValFormat).pack(*elemval[0])
+    return encode_outputs(ctx, elemval[1], out)
 
 
 #
@@ -746,18 +1033,20 @@ def decode_opthist(ctx, buf):
     opthist_decoder = ctx.create(OptHistFormat)
     opthist = OptHist._make(opthist_decoder.unpack_from(buf, 0))
     i = opthist_decoder.size
-    j, steps = decode_list(ctx, buf[i:], [
+    j, steps = decode_list(ctx, buf, [
         (OptHistValueFormat, OptHistValue),
-    ])
+    ], i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("opthist is too long")
     return (opthist, steps)
 
 
-def encode_opthist(ctx, opthist):
-    return ctx.create(OptHistFormat).pack(*opthist[0]) \
-           + encode_list(ctx, [OptHistValueFormat], opthist[1])
+def encode_opthist(ctx, opthist, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(OptHistFormat).pack(*opthist[0])
+    return encode_list(ctx, [OptHistValueFormat], opthist[1], out)
 
 
 #
@@ -781,20 +1070,22 @@ SimpleEVal = namedtuple('SimpleEVal', [
 ])
 
 
-def decode_simpleeval(ctx, buf):
+def decode_simpleeval(ctx, buf, as_array=False, types=None, lazy=False):
     simpleeval_decoder = ctx.create(SimpleEValFormat)
     eval = SimpleEVal._make(simpleeval_decoder.unpack_from(buf, 0))
     i = simpleeval_decoder.size
-    j, outputs = decode_outputs(ctx, buf[i:])
+    j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
     i += j
     if len(buf) - i > 0:
         raise DecodeError("simpleeval is too long")
     return (eval, outputs)
 
 
-def encode_simpleeval(ctx, simpleeval):
-    return ctx.create(SimpleEValFormat).pack(*simpleeval[0]) \
-           + encode_outputs(ctx, simpleeval[1])
+def encode_simpleeval(ctx, simpleeval, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(SimpleEValFormat).pack(*simpleeval[0])
+    return encode_outputs(ctx, simpleeval[1], out)
 
 
 #
@@ -819,7 +1110,7 @@ AreaId = namedtuple('AreaId', [
 ])
 
 
-def decode_nodeval_heat(ctx, buf):
+def decode_nodeval_heat(ctx, buf, as_array=False, types=None, lazy=False):
     nodeval_heat_decoder = ctx.create(NodeValHeatFormat)
     nodeval_heat = NodeValHeat._make(nodeval_heat_decoder.unpack_from(buf, 0))
     i = nodeval_heat_decoder.size
@@ -834,11 +1125,11 @@ def decode_nodeval_heat(ctx, buf):
             area_id = AreaId._make(area_id_decoder.unpack_from(buf, i))
             i += area_id_decoder.size
 
-            j, outputs = decode_outputs(ctx, buf[i:])
+            j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
             i += j
             values.append((area_id, outputs))
     else:
-        j, outputs = decode_outputs(ctx, buf[i:])
+        j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
         i += j
         values = outputs
 
@@ -847,18 +1138,20 @@ def decode_nodeval_heat(ctx, buf):
     return (nodeval_heat, values)
 
 
-def encode_nodeval_heat(ctx, nodeval_heat):
-    buf = ctx.create(NodeValHeatFormat).pack(*nodeval_heat[0])
+def encode_nodeval_heat(ctx, nodeval_heat, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(NodeValHeatFormat).pack(*nodeval_heat[0])
     values = nodeval_heat[1]
     if nodeval_heat[0].id == NodeValHeatId:
-        buf += ctx.create("i").pack(len(values))
+        out += ctx.create("i").pack(len(values))
         aread_id_encoder = ctx.create(AreaIdFormat)
         for v in values:
-            buf += aread_id_encoder.pack(*v[0]) \
-                   + encode_outputs(ctx, v[1])
+            out += aread_id_encoder.pack(*v[0])
+            encode_outputs(ctx, v[1], out)
     else:
-        buf += encode_outputs(ctx, values)
-    return buf
+        encode_outputs(ctx, values, out)
+    return out
 
 
 #
@@ -877,7 +1170,7 @@ ElemValHeat = namedtuple('ElemValHeat', [
 ])
 
 
-def decode_elemval_heat(ctx, buf):
+def decode_elemval_heat(ctx, buf, as_array=False, types=None, lazy=False):
     elemval_heat_decoder = ctx.create(ElemValHeatFormat)
     elemval_heat = ElemValHeat._make(elemval_heat_decoder.unpack_from(buf, 0))
     i = elemval_heat_decoder.size
@@ -892,11 +1185,11 @@ def decode_elemval_heat(ctx, buf):
             area_id = AreaId._make(area_id_decoder.unpack_from(buf, i))
             i += area_id_decoder.size
 
-            j, outputs = decode_outputs(ctx, buf[i:])
+            j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
             i += j
             values.append((area_id, outputs))
     else:
-        j, outputs = decode_outputs(ctx, buf[i:])
+        j, outputs = decode_outputs(ctx, buf, as_array, types, lazy, i)
         i += j
         values = outputs
 
@@ -905,18 +1198,556 @@ def decode_elemval_heat(ctx, buf):
     return (elemval_heat, values)
 
 
-def encode_elemval_heat(ctx, elemval_heat):
-    buf = ctx.create(ElemValHeatFormat).pack(*elemval_heat[0])
+def encode_elemval_heat(ctx, elemval_heat, out=None):
+    if out is None:
+        out = bytearray()
+    out += ctx.create(ElemValHeatFormat).pack(*elemval_heat[0])
     values = elemval_heat[1]
     if elemval_heat[0].id == ElemValHeatId:
-        buf += ctx.create("i").pack(len(values))
+        out += ctx.create("i").pack(len(values))
         aread_id_encoder = ctx.create(AreaIdFormat)
         for v in values:
-            buf += aread_id_encoder.pack(*v[0]) \
-                   + encode_outputs(ctx, v[1])
+            out += aread_id_encoder.pack(*v[0])
+            encode_outputs(ctx, v[1], out)
     else:
-        buf += encode_outputs(ctx, values)
-    return buf
+        encode_outputs(ctx, values, out)
+    return out
+
+
+# ================================
+# レコード走査
+# ================================
+
+# decoder of each record id, used by Record.decode
+Decoders = {
+    TitleId: decode_title,
+    ParamId: decode_param,
+    BaseinfoId: decode_baseinfo,
+    RSCaseId: decode_rscase,
+    ModelinfId: decode_modelinf,
+    SimpleResultId: decode_simple_result,
+    DataPropId: decode_dataprop,
+    NodeValId: decode_nodeval,
+    ElemValId: decode_elemval,
+    OptHistId: decode_opthist,
+    SimpleEValId: decode_simpleeval,
+    NodeValHeatId: decode_nodeval_heat,
+    ElemValHeatId: decode_elemval_heat,
+}
+
+# encoder of each record id, used by rewrite
+Encoders = {
+    TitleId: encode_title,
+    ParamId: encode_param,
+    BaseinfoId: encode_baseinfo,
+    RSCaseId: encode_rscase,
+    ModelinfId: encode_modelinf,
+    SimpleResultId: encode_simple_result,
+    DataPropId: encode_dataprop,
+    NodeValId: encode_nodeval,
+    ElemValId: encode_elemval,
+    OptHistId: encode_opthist,
+    SimpleEValId: encode_simpleeval,
+    NodeValHeatId: encode_nodeval_heat,
+    ElemValHeatId: encode_elemval_heat,
+}
+
+
+class Record:
+    """
+    Record found by iter_records
+
+    read returns the body as memoryview of the memory-mapped file, read / decode copy nothing.
+    the view is sliced on read only, so a record does not keep the file mapped by itself,
+    and it can be read only while iter_records is iterating.
+    offset and length are those of the body without the length prefix and trailer.
+    """
+
+    def __init__(self, ctx, buf, recid, offset, length):
+        self.ctx = ctx
+        self.buf = buf
+        self.recid = recid
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        return self.buf[self.offset:self.offset + self.length]
+
+    def decode(self, **kwargs):
+        decoder = Decoders.get(self.recid)
+        if decoder is None:
+            raise DecodeError("unknown recid", self.recid)
+        return decoder(self.ctx, self.read(), **kwargs)
+
+    def __repr__(self):
+        return 'Record({}, {}, {})'.format(self.recid, self.offset, self.length)
+
+
+def iter_records(path_or_file, recids=None):
+    """
+    yield Record of every record, or only of recids
+
+    the file is memory-mapped, only the pages of the records read are loaded.
+    the file is opened and closed here when the path is given.
+    """
+    if isinstance(path_or_file, (str, bytes, os.PathLike)):
+        with open(path_or_file, "rb") as f:
+            yield from iter_records(f, recids)
+        return
+    f = path_or_file
+    f.seek(0)
+    byteorder, header, version = decode_header(f)
+    ctx = Context(byteorder, header.size_of_int, header.size_of_real)
+    size = ctx.create("i").size
+    with RecordReader(ctx, f) as reader:
+        buf = reader.next_record()
+        while buf is not None:
+            recid = decode_recid(ctx, buf)
+            length = len(buf)
+            # Record.read slices the body again, no view is held here while the caller runs
+            buf.release()
+            if recids is None or recid in recids:
+                yield Record(ctx, reader.buf, recid, reader.offset + size, length)
+            buf = reader.next_record()
+
+
+# ================================
+# レコード書き換え
+# ================================
+
+# buffer size of copy_range when the kernel can not copy between the files
+COPY_BUFFER_SIZE = 1 << 20
+
+# errors meaning the copy is not supported for the files, next way is tried
+_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK)
+
+
+def _copy_file_range(src, dst, offset, pos, length):
+    return os.copy_file_range(src.fileno(), dst.fileno(), length, offset, pos)
+
+
+def _sendfile(src, dst, offset, pos, length):
+    # sendfile writes at the file position of dst
+    os.lseek(dst.fileno(), pos, os.SEEK_SET)
+    return os.sendfile(dst.fileno(), src.fileno(), offset, length)
+
+
+def _copy_buffered(src, dst, offset, pos, length):
+    src.seek(offset)
+    buf = src.read(min(length, COPY_BUFFER_SIZE))
+    dst.seek(pos)
+    dst.write(buf)
+    return len(buf)
+
+
+_copiers = []
+if hasattr(os, "copy_file_range"):
+    _copiers.append(_copy_file_range)
+if hasattr(os, "sendfile"):
+    _copiers.append(_sendfile)
+_copiers.append(_copy_buffered)
+
+
+def copy_range(src, dst, offset, length):
+    """
+    copy length bytes at offset of src to the current position of dst
+
+    the bytes are copied in the kernel by copy_file_range or sendfile when
+    the files allow it, otherwise they are read and written through a buffer.
+    """
+    if length == 0:
+        return
+    dst.flush()
+    pos = dst.tell()
+    copied = 0
+    for copier in _copiers:
+        try:
+            while copied < length:
+                n = copier(src, dst, offset + copied, pos + copied, length - copied)
+                if n == 0:
+                    raise DecodeError("record is truncated", offset + copied)
+                copied += n
+            break
+        except io.UnsupportedOperation:
+            # no file descriptor, e.g. io.BytesIO
+            continue
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    dst.seek(pos + length)
+
+
+def _same_file(src, dst):
+    # src is a file object, dst a path or a file object
+    try:
+        src_stat = os.fstat(src.fileno())
+        if isinstance(dst, (str, bytes, os.PathLike)):
+            dst_stat = os.stat(dst)
+        else:
+            dst_stat = os.fstat(dst.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        # dst does not exist yet or the files have no descriptor
+        return False
+    return os.path.samestat(src_stat, dst_stat)
+
+
+def rewrite(src, dst, callback):
+    """
+    copy the .vre file src to dst, replacing the records chosen by callback
+
+    callback is called with every Record and returns None to keep the record,
+    or the new value encoded by Encoders, or the new body as bytes.
+    runs of kept records are copied by copy_range without being read.
+    returns the number of replaced records.
+    """
+    if isinstance(src, (str, bytes, os.PathLike)):
+        with open(src, "rb") as f:
+            return rewrite(f, dst, callback)
+    # opening dst for writing would empty src before it is read
+    if _same_file(src, dst):
+        raise Exception("src and dst are the same file", dst)
+    if isinstance(dst, (str, bytes, os.PathLike)):
+        with open(dst, "wb") as f:
+            return rewrite(src, f, callback)
+    src.seek(0)
+    decode_header(src)
+    # the header and version records are kept as is
+    start = 0
+    end = src.tell()
+    writer = None
+    n = 0
+    for record in iter_records(src):
+        value = callback(record)
+        record_end = record.offset + record.length + record.ctx.size_of_int
+        if value is None:
+            end = record_end
+            continue
+        copy_range(src, dst, start, end - start)
+        if writer is None:
+            writer = RecordWriter(record.ctx, dst)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            writer.write_body(value)
+        else:
+            encoder = Encoders.get(record.recid)
+            if encoder is None:
+                raise DecodeError("unknown recid", record.recid)
+            writer.write_record(encoder, value)
+        n += 1
+        start = end = record_end
+    copy_range(src, dst, start, end - start)
+    dst.flush()
+    return n
+
+
+# ================================
+# レコードインデックス
+# ================================
+
+#
+# ステップ
+#
+Step = namedtuple('Step', [
+    # サブケースID
+    'subcase_id',
+
+    # ステップ数
+    'i_step',
+
+    # 時刻
+    'time',
+
+    # 固有モードID
+    'mode_id',
+
+    # ボクセル／STLモデルID
+    'voxmodel_id',
+])
+
+
+def dataprop_step(dataprop):
+    return Step(dataprop.subcase_id, dataprop.i_step, dataprop.time, dataprop.mode_id, dataprop.voxmodel_id)
+
+
+#
+# レコード
+#
+IndexEntry = namedtuple('IndexEntry', [
+    # レコードID
+    'recid',
+
+    # レコード本体のファイル内位置
+    'offset',
+
+    # レコード本体の長さ
+    'length',
+
+    # 直前のデータ属性 (なければ None)
+    'step',
+
+    # データセット
+    'outputs',
+])
+# データセット
+IndexOutput = namedtuple('IndexOutput', [
+    # タイプ
+    'type',
+
+    # 値のファイル内位置
+    'offset',
+
+    # 値の数
+    'count',
+
+    # 実数データ長
+    'size_of_real',
+])
+
+# records whose body is NodeVal-like : header followed by decode_outputs
+OutputsRecordIds = {
+    NodeValId: NodeValFormat,
+    ElemValId: ElemValFormat,
+    SimpleEValId: SimpleEValFormat,
+}
+
+# sidecar file layout, always little endian
+IndexMagic = b'VREIDX01'
+IndexHeaderFormat = '<8sqqciiq'
+IndexEntryFormat = '<iqq?iidiii'
+IndexOutputFormat = '<iqqi'
+
+
+def scan_outputs(ctx, buf, i=0):
+    """
+    walk decode_outputs layout without decoding values
+
+    returns the end position and (output, position of values, count) of each dataset.
+    """
+    size_decoder = ctx.create("i")
+    output_decoder = ctx.create(OutputFormat)
+
+    n, = size_decoder.unpack_from(buf, i)
+    i += size_decoder.size
+
+    outputs = []
+    for _ in range(n):
+        output = Output._make(output_decoder.unpack_from(buf, i))
+        i += output_decoder.size
+        count, = size_decoder.unpack_from(buf, i)
+        i += size_decoder.size
+        outputs.append((output, i, count))
+        i += count * output.size_of_real
+    if i > len(buf):
+        raise DecodeError("outputs are truncated")
+    return (i, outputs)
+
+
+class RecordIndex:
+    """
+    Offset of every record in the .vre file
+
+    built once by scanning the record framing with build_index and saved
+    to the sidecar file next to the .vre (see open_index).
+    """
+
+    def __init__(self, filename, byteorder, size_of_int, size_of_real, entries):
+        self.filename = filename
+        self.byteorder = byteorder
+        self.size_of_int = size_of_int
+        self.size_of_real = size_of_real
+        self.entries = entries
+
+    def context(self):
+        return Context(self.byteorder, self.size_of_int, self.size_of_real)
+
+    def steps(self):
+        return [e.step for e in self.entries if e.recid == DataPropId]
+
+    def find(self, type=None, recid=None, **step):
+        """
+        find datasets by output type and Step fields
+
+        index.find(VON_MISES_STRESS, i_step=350) returns [(entry, output), ...]
+        """
+        found = []
+        for entry in self.entries:
+            if not entry.outputs or (recid is not None and entry.recid != recid):
+                continue
+            if step and (entry.step is None or any(getattr(entry.step, k) != v for k, v in step.items())):
+                continue
+            for output in entry.outputs:
+                if type is None or output.type == type:
+                    found.append((entry, output))
+        return found
+
+    def read(self, f, entry):
+        f.seek(entry.offset)
+        return f.read(entry.length)
+
+
+def build_index(filename):
+    with open(filename, "rb") as f:
+        byteorder, header, version = decode_header(f)
+        ctx = Context(byteorder, header.size_of_int, header.size_of_real)
+        entries = []
+        step = None
+        with RecordReader(ctx, f) as reader:
+            buf = reader.next_record()
+            while buf is not None:
+                offset = reader.offset + ctx.size_of_int
+                recid = decode_recid(ctx, buf)
+                outputs = ()
+                if recid == DataPropId:
+                    step = dataprop_step(decode_dataprop(ctx, buf))
+                elif recid in OutputsRecordIds:
+                    _, scanned = scan_outputs(ctx, buf, ctx.create(OutputsRecordIds[recid]).size)
+                    outputs = tuple(IndexOutput(output.type, offset + i, count, output.size_of_real)
+                                    for output, i, count in scanned)
+                entries.append(IndexEntry(recid, offset, len(buf), step, outputs))
+                buf.release()
+                buf = reader.next_record()
+    return RecordIndex(filename, byteorder, header.size_of_int, header.size_of_real, entries)
+
+
+def index_filename(filename):
+    return filename + ".idx"
+
+
+def save_index(index, sidecar=None):
+    st = os.stat(index.filename)
+    header_encoder = struct.Struct(IndexHeaderFormat)
+    entry_encoder = struct.Struct(IndexEntryFormat)
+    output_encoder = struct.Struct(IndexOutputFormat)
+    buf = bytearray(header_encoder.pack(IndexMagic, st.st_size, st.st_mtime_ns, index.byteorder.encode(),
+                                        index.size_of_int, index.size_of_real, len(index.entries)))
+    for e in index.entries:
+        step = e.step if e.step is not None else Step(0, 0, 0.0, 0, 0)
+        buf += entry_encoder.pack(e.recid, e.offset, e.length, e.step is not None, *step, len(e.outputs))
+        for o in e.outputs:
+            buf += output_encoder.pack(*o)
+    # written to a temporary file and renamed, a reader never sees a partial sidecar
+    sidecar = sidecar or index_filename(index.filename)
+    tmp = sidecar + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(buf)
+        os.replace(tmp, sidecar)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def load_index(filename, sidecar=None):
+    """
+    load the sidecar index, returns None if it is missing, stale or broken
+    """
+    try:
+        with open(sidecar or index_filename(filename), "rb") as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return None
+    header_decoder = struct.Struct(IndexHeaderFormat)
+    entry_decoder = struct.Struct(IndexEntryFormat)
+    output_decoder = struct.Struct(IndexOutputFormat)
+    if len(buf) < header_decoder.size:
+        return None
+    magic, size, mtime_ns, byteorder, size_of_int, size_of_real, n = header_decoder.unpack_from(buf, 0)
+    st = os.stat(filename)
+    if magic != IndexMagic or size != st.st_size or mtime_ns != st.st_mtime_ns:
+        return None
+    i = header_decoder.size
+    if n < 0 or n * entry_decoder.size > len(buf) - i:
+        return None
+    entries = []
+    try:
+        for _ in range(n):
+            recid, offset, length, has_step, *step, n_outputs = entry_decoder.unpack_from(buf, i)
+            i += entry_decoder.size
+            if n_outputs < 0 or n_outputs * output_decoder.size > len(buf) - i:
+                return None
+            outputs = tuple(IndexOutput._make(output_decoder.unpack_from(buf, i + j * output_decoder.size))
+                            for j in range(n_outputs))
+            i += n_outputs * output_decoder.size
+            entries.append(IndexEntry(recid, offset, length, Step._make(step) if has_step else None, outputs))
+    except struct.error:
+        return None
+    if i != len(buf) or byteorder not in (b'<', b'>'):
+        return None
+    return RecordIndex(filename, byteorder.decode(), size_of_int, size_of_real, entries)
+
+
+def open_index(filename, sidecar=None):
+    index = load_index(filename, sidecar)
+    if index is None:
+        index = build_index(filename)
+        try:
+            save_index(index, sidecar)
+        except OSError:
+            # e.g. read only directory, the index is built again next time
+            pass
+    return index
+
+
+class MappedResult:
+    """
+    Values of every dataset as views into one read only mapping of the .vre
+
+    opening costs the index scan only (open_index), values are read from the
+    page cache on access. views keep the byteorder of the file and are not
+    aligned when the offset of the values is not a multiple of size_of_real,
+    native / take return native aligned values.
+
+    with MappedResult("result.vre") as result:
+        for entry, output in result.index.find(VON_MISES_STRESS):
+            values = result.take(output, voxel_indices)
+    """
+
+    def __init__(self, filename, index=None, sidecar=None):
+        self.index = index or open_index(filename, sidecar)
+        self.ctx = self.index.context()
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def dtype(self, output):
+        return output_dtype(self.ctx, output)
+
+    def view(self, output):
+        """
+        read only view of the values of IndexOutput in the byteorder of the file, no bytes are copied
+        """
+        return np.frombuffer(self._mmap, dtype=self.dtype(output), count=output.count, offset=output.offset)
+
+    def native(self, output):
+        """
+        values of IndexOutput in native byteorder, the view itself when it is native and aligned
+        """
+        return as_native(self.view(output))
+
+    def take(self, output, indices):
+        """
+        native values at indices, only the selected values are byteswapped
+        """
+        return to_native(self.view(output)[indices])
+
+    def close(self):
+        """
+        unmap the file, the views returned by view / native must be released before
+
+        a view still held keeps the file mapped until it is released.
+        """
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a view is still held by the caller, the mapping is unmapped when the last one is released
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 # ================================
@@ -1101,72 +1932,63 @@ ELECTROMAGNETIC_FORCE_VECTOR_Y = 3242
 ELECTROMAGNETIC_FORCE_VECTOR_Z = 3243
 
 if __name__ == '__main__':
-    f = open("./tmp/test.vre", "rb")
-    f2 = open("./tmp/test2.vre", "wb")
-    byteorder, header, version = decode_header(f)
-    ctx = Context(byteorder, header.size_of_int, header.size_of_real)
-    f2.write(encode_header(ctx, header, version))
-
-    buf = ctx.next_record(f)
-    while buf is not None:
-        recid = decode_recid(ctx, ctx.unwrap_record(buf))
+    def callback(record):
+        recid = record.recid
         if recid == TitleId:
-            # title = decode_title(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_title(ctx, title))
+            # title = record.decode()
+            # return title
             print("skip Title")
         elif recid == ParamId:
-            # param = decode_param(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_param(ctx, param))
+            # param = record.decode()
+            # return param
             print("skip Param")
         elif recid == BaseinfoId:
-            # baseinfo = decode_baseinfo(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_baseinfo(ctx, baseinfo))
+            # baseinfo = record.decode()
+            # return baseinfo
             print("skip Baseinfo")
         elif recid == RSCaseId:
-            # rscase = decode_rscase(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_rscase(ctx, rscase))
+            # rscase = record.decode()
+            # return rscase
             print("skip RSCase")
         elif recid == ModelinfId:
-            # modelinf = decode_modelinf(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_modelinf(ctx, modelinf))
+            # modelinf = record.decode()
+            # return modelinf
             print("skip Modelinf")
         elif recid == SimpleResultId:
-            # simple_result = decode_simple_result(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_simple_result(ctx, simple_result))
+            # simple_result = record.decode()
+            # return simple_result
             print("skip SimpleResult")
         elif recid == DataPropId:
-            # dataprop = decode_dataprop(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_dataprop(ctx, dataprop))
+            # dataprop = record.decode()
+            # return dataprop
             print("skip DataProp")
         elif recid == NodeValId:
-            # nodeval = decode_nodeval(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_nodeval(ctx, nodeval))
+            # nodeval = record.decode()
+            # return nodeval
             print("skip NodeVal")
         elif recid == ElemValId:
-            # elemval = decode_elemval(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_elemval(ctx, elemval))
+            # elemval = record.decode()
+            # return elemval
             print("skip ElemVal")
         elif recid == OptHistId:
-            # opthist = decode_opthist(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_opthist(ctx, opthist))
+            # opthist = record.decode()
+            # return opthist
             print("skip OptHist")
         elif recid == SimpleEValId:
-            # simple_eval = decode_simpleeval(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_simpleeval(ctx, simple_eval))
+            # simple_eval = record.decode()
+            # return simple_eval
             print("skip SimpleEVal")
         elif recid == NodeValHeatId:
-            # nodeval_heat = decode_nodeval_heat(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_nodeval_heat(ctx, nodeval_heat))
+            # nodeval_heat = record.decode()
+            # return nodeval_heat
             print("skip NodeValHeat")
         elif recid == ElemValHeatId:
-            # elemval_heat = decode_elemval_heat(ctx, ctx.unwrap_record(buf))
-            # buf = ctx.wrap_record(encode_elemval_heat(ctx, elemval_heat))
+            # elemval_heat = record.decode()
+            # return elemval_heat
             print("skip ElemValHeat")
         else:
             print("unknown recid :", recid)
-        # write back
-        f2.write(buf)
-        buf = ctx.next_record(f)
+        # keep the record as is
+        return None
 
-    f.close()
-    f2.close()
+    rewrite("./tmp/test.vre", "./tmp/test2.vre", callback)